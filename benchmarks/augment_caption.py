@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""Compares CaptionWithMecab.augment_caption with the former two-pass implementation.
+
+usage: python benchmarks/augment_caption.py [--captions 20000] [--paren_pairs 2000] [--repeat 3]
+"""
+
+from pathlib import Path
+from typing import List, Optional
+import argparse
+import datetime
+import random
+import re
+import sys
+import timeit
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import MeCab  # noqa: E402
+import jaconv  # noqa: E402
+
+from movie_and_captions.caption_with_mecab import CaptionWithMecab  # noqa: E402
+from movie_and_captions.models import Caption, AugmentedCaption  # noqa: E402
+
+
+class TwoPassCaptionWithMecab(CaptionWithMecab):
+    """The implementation before the single-pass one (yomi and short title are parsed apart)."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._build_taggers()
+        self._mecab_yomi = MeCab.Tagger('-Oyomi')
+        self._mecab_yomi.parse('')
+        self._removing_parens_regex = re.compile(r'[\(（<]([^\(（<\)）>]*)[\)）>]')
+
+    def augment_caption(self, caption: Caption) -> Optional[AugmentedCaption]:
+        text = caption.content
+        text = text.replace('\n', '')
+        while True:
+            match = self._removing_parens_regex.search(text)
+            if match is None:
+                break
+            text = text[:match.start()] + text[match.end():]
+            if len(text) == 0:
+                return None
+        match = self._saving_parens_regex.search(text)
+        if match is not None:
+            text_candidate = match.group(1)
+            if len(text_candidate) >= len(text) / 2:
+                text = text_candidate
+        if len(text) == 0:
+            return None
+        yomi_katakana = self._mecab_yomi.parse(text).strip()
+        yomi = jaconv.kata2hira(yomi_katakana)
+        if len(text) <= self._short_title_length_range['min']:
+            short_title = text
+        else:
+            mecab_node = self._mecab_tagger.parseToNode(text).next
+            text_ends = 0
+            previous_continuous_flag = False
+            while mecab_node is not None and mecab_node.next is not None:
+                check_length = True
+                feature_posid = mecab_node.posid
+                if feature_posid in self._not_selfstanding_poses:
+                    check_length = False
+                if previous_continuous_flag:
+                    previous_continuous_flag = False
+                    check_length = False
+                if feature_posid in self._not_ending_poses:
+                    previous_continuous_flag = True
+                text_ends_will_be = text_ends + len(mecab_node.surface)
+                if check_length and text_ends_will_be >= self._short_title_length_range['min']:
+                    break
+                if text_ends_will_be >= self._short_title_length_range['max']:
+                    break
+                text_ends = text_ends_will_be
+                mecab_node = mecab_node.next
+            short_title = text[:text_ends]
+        return AugmentedCaption(short_title=short_title, yomi=yomi, **caption._asdict())
+
+
+FIXTURE_CONTENTS = [
+    'こんにちは！', 'シロです。', '(笑)', '[音楽]', '<拍手>', 'えっ？',
+    'シロ「こんにちは！」', '最高に「ハイ！」ってやつだ', "'quoted' words", '"double" quoted',
+    '今日はいい天気ですね\nお散歩しましょう', 'ばあちゃる（馬）「はいはいはい」',
+    'みんなで一緒にご飯を食べに行きましょう、ね？楽しみだなあ', '(入れ子(の)括弧)だけ残る)',
+    'a)(b', '(閉じない括弧', 'Hello World  from  YouTube', '　全角スペース　です　',
+    '使いづらいったらしいかしら思いけむAかBとかC思います行ってしまう',
+    'これは非常に長い字幕の例でありまして、短いタイトルを作るための区切りを確認しています',
+    'ＡＢＣ１２３とｶﾀｶﾅ', '🐬イルカ🐬', 'ｗｗｗ', '…。', '',
+]
+
+
+def make_captions(number: int, seed: int = 0) -> List[Caption]:
+    random_generator = random.Random(seed)
+    captions = []
+    for i in range(number):
+        parts = random_generator.sample(FIXTURE_CONTENTS, random_generator.randint(1, 4))
+        # long cues with many parentheses
+        if i % 100 == 0:
+            parts.append('(あ)' * 200 + 'い')
+        begin = datetime.time(i // 3600 % 24, i // 60 % 60, i % 60)
+        captions.append(Caption(begin, begin, ''.join(parts)))
+    return captions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--captions', type=int, default=20000)
+    parser.add_argument('--paren_pairs', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=3)
+    params = parser.parse_args()
+
+    captions = make_captions(params.captions)
+    # long cues with many parentheses, where the former implementation is quadratic
+    paren_captions = [Caption(caption.begin, caption.end, '(あ)' * params.paren_pairs + 'い')
+                      for caption in captions[:100]]
+    single_pass = CaptionWithMecab()
+    two_pass = TwoPassCaptionWithMecab()
+    expected = [two_pass.augment_caption(caption) for caption in captions]
+    actual = [single_pass.augment_caption(caption) for caption in captions]
+    mismatches = [(e, a) for e, a in zip(expected, actual) if e != a]
+    for e, a in mismatches[:10]:
+        print('mismatch:\n  {}\n  {}'.format(e, a))
+    assert not mismatches
+    print('{} captions, outputs are identical'.format(len(captions)))
+
+    assert ([two_pass.augment_caption(caption) for caption in paren_captions]
+            == [single_pass.augment_caption(caption) for caption in paren_captions])
+
+    for corpus_name, corpus in [('fixture', captions), ('parentheses', paren_captions)]:
+        for name, augmenter in [('two-pass', two_pass), ('single-pass', single_pass)]:
+            seconds = min(timeit.repeat(
+                lambda: [augmenter.augment_caption(caption) for caption in corpus],
+                number=1, repeat=params.repeat))
+            print('{:12s} {:12s} {:8.1f} ms  {:10.0f} cues/sec'.format(
+                corpus_name, name, seconds * 1000, len(corpus) / seconds))
+
+
+if __name__ == '__main__':
+    main()
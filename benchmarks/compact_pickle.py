@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""Compares the pickle of the data (lists of dicts) with the one made with `--compact_pickle`.
+
+usage: python benchmarks/compact_pickle.py [--videos 300] [--captions_per_video 1000]
+"""
+
+from pathlib import Path
+from typing import Any, Callable, Tuple
+import argparse
+import datetime
+import gc
+import pickle
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from movie_and_captions.data import Data, VideoDatum, compact_data, expand_data  # noqa: E402
+
+
+def make_video_datum(index: int, caption_num: int) -> VideoDatum:
+    rng = random.Random(index)
+    captions = []
+    augmented_captions = []
+    for i in range(caption_num):
+        begin = (datetime.datetime.min + datetime.timedelta(milliseconds=2000 * i)).time()
+        end = (datetime.datetime.min
+               + datetime.timedelta(milliseconds=2000 * i + rng.randint(500, 1999))).time()
+        content = 'キャプション{}の{}番目です'.format(index, rng.randint(0, 10 ** 6))
+        captions.append(dict(begin=begin, end=end, content=content))
+        augmented_captions.append(dict(begin=begin, end=end, content=content,
+                                       short_title=content[:12], yomi='きゃぷしょん'))
+    return dict(video_info=dict(video_id='video{:07d}'.format(index)),
+                caption_info=dict(last_updated=index),
+                captions=captions, augmented_captions=augmented_captions,
+                augmentation_info=dict(version=1, last_updated=index))
+
+
+def measure_seconds(function: Callable[[], Any]) -> Tuple[Any, float]:
+    start = time.perf_counter()
+    result = function()
+    return result, time.perf_counter() - start
+
+
+def measure_memory(function: Callable[[], Any]) -> float:
+    """Returns the memory held by the result of `function` in MB."""
+    gc.collect()
+    tracemalloc.start()
+    result = function()  # noqa: F841
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return memory / 1024 / 1024
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--videos', type=int, default=300)
+    parser.add_argument('--captions_per_video', type=int, default=1000)
+    params = parser.parse_args()
+
+    data: Data = [make_video_datum(index, params.captions_per_video)
+                  for index in range(params.videos)]
+    compacted, compact_seconds = measure_seconds(lambda: compact_data(data))
+    expanded, expand_seconds = measure_seconds(lambda: expand_data(compacted))
+    assert expanded == data
+    del expanded
+    print('compact_data {:.2f} s, expand_data {:.2f} s'.format(compact_seconds, expand_seconds))
+
+    for name, value in [('lists of dicts', data), ('compact', compacted)]:
+        pickled, dump_seconds = measure_seconds(lambda: pickle.dumps(value))
+        _, load_seconds = measure_seconds(lambda: pickle.loads(pickled))
+        memory = measure_memory(lambda: pickle.loads(pickled))
+        print('{:15s} {:7.1f} MB pickle, dump {:5.2f} s, load {:5.2f} s, {:7.1f} MB in memory'
+              .format(name, len(pickled) / 1024 / 1024, dump_seconds, load_seconds, memory))
+        del pickled
+
+
+if __name__ == '__main__':
+    main()
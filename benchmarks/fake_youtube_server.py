@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""Local stand-in for the youtube data api and the timedtext api, serving synthetic channels.
+
+It serves channels.list, playlistItems.list (paged), videos.list and captions.list under
+/youtube/v3/, and the WebVTT captions under /api/timedtext. Every channel id has `videos`
+videos with Japanese captions, generated deterministically from the ids. The latency and
+the rates of 500 / 429 errors are configurable, and /stats returns the number of the
+requests and the quota units used so far.
+
+usage: python benchmarks/fake_youtube_server.py [--port 8080] [--videos 200]
+           [--latency_ms 50] [--error_rate 0.01] [--rate_429 0.01]
+       then run main.py with --api_root_url http://127.0.0.1:8080/
+           --timedtext_url http://127.0.0.1:8080/api/timedtext
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, Any, List, Tuple, Optional
+import argparse
+import collections
+import datetime
+import hashlib
+import json
+import random
+import sys
+import threading
+import time
+import urllib.parse
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from movie_and_captions.youtube_api.quota import quota_cost  # noqa: E402
+
+
+PHRASES = [
+    'こんにちは', 'みなさん', '今日は', 'ゲームを', 'やっていきたいと思います', 'よろしくお願いします',
+    'これは', 'すごい', 'ですね', 'ちょっと待って', 'なんで', 'いけるいける', 'ありがとうございます',
+    '最高に', 'ハイ！', 'ってやつだ', 'あれ？', 'どうしよう', '見てください', 'かわいい',
+    'おやすみなさい', 'また明日', '頑張ります', '負けた', '勝った', 'やったー', '本当に',
+]
+DECORATIONS = ['（笑）', '(拍手)', '<i>♪</i>', '']
+SPEAKERS = ['シロ', 'ばあちゃる', '']
+
+
+class FakeYoutube:
+    """The synthetic data of the fake server, shared by all the handler threads."""
+
+    def __init__(
+            self,
+            videos: int = 200,
+            cues_per_video: Tuple[int, int] = (200, 600),
+            latency: float = 0.0,
+            error_rate: float = 0.0,
+            rate_429: float = 0.0,
+            seed: int = 0
+    ) -> None:
+        self.videos = videos
+        self.cues_per_video = cues_per_video
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_429 = rate_429
+        self.seed = seed
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+        self._issued_video_ids: Dict[str, Tuple[str, int]] = {}
+        self.requests: Dict[str, int] = collections.Counter()
+        self.quota = 0
+
+    def _video_id(self, channel_id: str, index: int) -> str:
+        return hashlib.blake2b('{}/{}'.format(channel_id, index).encode(),
+                               digest_size=8).hexdigest()[:11]
+
+    def _published(self, index: int) -> datetime.datetime:
+        # the video with the largest index is the newest one
+        return (datetime.datetime(2018, 1, 1, tzinfo=datetime.timezone.utc)
+                + datetime.timedelta(hours=12 * index))
+
+    def _issue(self, channel_id: str, index: int) -> str:
+        video_id = self._video_id(channel_id, index)
+        with self._lock:
+            self._issued_video_ids[video_id] = (channel_id, index)
+        return video_id
+
+    def _video_index(self, video_id: str) -> Optional[Tuple[str, int]]:
+        # the video ids are resolved to the ones listed by playlistItems.list
+        with self._lock:
+            return self._issued_video_ids.get(video_id)
+
+    def count(self, method_id: str) -> None:
+        with self._lock:
+            self.requests[method_id] += 1
+            if method_id.startswith('youtube.'):
+                self.quota += quota_cost(method_id)
+
+    def failure(self) -> Optional[int]:
+        with self._lock:
+            dice = self._random.random()
+        if dice < self.rate_429:
+            return 429
+        if dice < self.rate_429 + self.error_rate:
+            return 500
+        return None
+
+    def list_channels(self, query: Dict[str, str]) -> Dict[str, Any]:
+        channel_id = query['id']
+        return dict(items=[dict(id=channel_id, contentDetails=dict(
+            relatedPlaylists=dict(uploads='UU' + channel_id)))])
+
+    def list_playlist_items(self, query: Dict[str, str]) -> Dict[str, Any]:
+        channel_id = query['playlistId'][2:]
+        max_results = int(query.get('maxResults', '5'))
+        start = int(query.get('pageToken', '0'))
+        indices = range(self.videos - 1 - start, max(-1, self.videos - 1 - start - max_results),
+                        -1)
+        items = [dict(contentDetails=dict(
+            videoId=self._issue(channel_id, index),
+            videoPublishedAt=self._published(index).strftime('%Y-%m-%dT%H:%M:%S.000Z')))
+            for index in indices]
+        response: Dict[str, Any] = dict(items=items)
+        if start + max_results < self.videos:
+            response['nextPageToken'] = str(start + max_results)
+        return response
+
+    def list_videos(self, query: Dict[str, str]) -> Dict[str, Any]:
+        items = []
+        for video_id in query['id'].split(','):
+            found = self._video_index(video_id)
+            if found is None:
+                continue
+            channel_id, index = found
+            items.append(dict(id=video_id, snippet=dict(
+                title='{} の動画 #{}'.format(channel_id, index),
+                publishedAt=self._published(index).strftime('%Y-%m-%dT%H:%M:%S.000Z'))))
+        return dict(items=items)
+
+    def list_captions(self, query: Dict[str, str]) -> Dict[str, Any]:
+        found = self._video_index(query['videoId'])
+        if found is None:
+            return dict(items=[])
+        _, index = found
+        last_updated = self._published(index) + datetime.timedelta(days=1)
+        snippet = dict(name='', lastUpdated=last_updated.strftime('%Y-%m-%dT%H:%M:%S.000Z'))
+        return dict(items=[
+            dict(id='ja.' + query['videoId'],
+                 snippet=dict(snippet, language='ja', trackKind='standard')),
+            dict(id='asr.' + query['videoId'],
+                 snippet=dict(snippet, language='ja', trackKind='ASR')),
+        ])
+
+    def webvtt(self, video_id: str) -> str:
+        rng = random.Random('{}/{}'.format(self.seed, video_id))
+        lines = ['WEBVTT', 'Kind: captions', 'Language: ja', '']
+        milliseconds = 0
+        for _ in range(rng.randint(*self.cues_per_video)):
+            begin = milliseconds + rng.randint(0, 500)
+            end = begin + rng.randint(800, 4000)
+            milliseconds = end
+            text = ''.join(rng.choice(PHRASES) for _ in range(rng.randint(1, 5)))
+            text = rng.choice(SPEAKERS) + ('「{}」'.format(text) if rng.random() < 0.1 else text)
+            text += rng.choice(DECORATIONS) if rng.random() < 0.2 else ''
+            lines.append('{} --> {}'.format(_timestamp(begin), _timestamp(end)))
+            lines.extend(_wrap(text, 16))
+            lines.append('')
+        return '\n'.join(lines)
+
+
+def _timestamp(milliseconds: int) -> str:
+    seconds, milliseconds = divmod(milliseconds, 1000)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{:02d}:{:02d}:{:02d}.{:03d}'.format(hours, minutes, seconds, milliseconds)
+
+
+def _wrap(text: str, width: int) -> List[str]:
+    return [text[i:i + width] for i in range(0, len(text), width)]
+
+
+def make_handler(fake_youtube: FakeYoutube) -> type:
+    api_methods = {
+        '/youtube/v3/channels': ('youtube.channels.list', fake_youtube.list_channels),
+        '/youtube/v3/playlistItems': ('youtube.playlistItems.list',
+                                      fake_youtube.list_playlist_items),
+        '/youtube/v3/videos': ('youtube.videos.list', fake_youtube.list_videos),
+        '/youtube/v3/captions': ('youtube.captions.list', fake_youtube.list_captions),
+    }
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def _send(self, status: int, body: bytes, content_type: str,
+                  etag: Optional[str] = None) -> None:
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            if etag is not None:
+                self.send_header('ETag', etag)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _send_error(self, status: int) -> None:
+            reason = 'rateLimitExceeded' if status == 429 else 'backendError'
+            body = json.dumps(dict(error=dict(code=status, errors=[dict(reason=reason)])))
+            self._send(status, body.encode('utf-8'), 'application/json')
+
+        def do_GET(self) -> None:
+            url = urllib.parse.urlsplit(self.path)
+            query = dict(urllib.parse.parse_qsl(url.query))
+            if url.path == '/stats':
+                body = json.dumps(dict(requests=fake_youtube.requests, quota=fake_youtube.quota))
+                self._send(200, body.encode('utf-8'), 'application/json')
+                return
+            if url.path in api_methods:
+                method_id, method = api_methods[url.path]
+            elif url.path == '/api/timedtext':
+                method_id, method = 'timedtext', None
+            else:
+                self._send(404, b'', 'text/plain')
+                return
+
+            fake_youtube.count(method_id)
+            if fake_youtube.latency > 0:
+                time.sleep(fake_youtube.latency * random.uniform(0.5, 1.5))
+            status = fake_youtube.failure()
+            if status is not None:
+                self._send_error(status)
+                return
+
+            if method is None:
+                body = fake_youtube.webvtt(query.get('v', '')).encode('utf-8')
+                self._send(200, body, 'text/vtt; charset=utf-8')
+                return
+            response = method(query)
+            etag = '"{}"'.format(hashlib.blake2b(json.dumps(response, sort_keys=True).encode(),
+                                                 digest_size=8).hexdigest())
+            response['etag'] = etag
+            if self.headers.get('If-None-Match') == etag:
+                self._send(304, b'', 'application/json', etag)
+                return
+            self._send(200, json.dumps(response).encode('utf-8'), 'application/json', etag)
+
+        def log_message(self, format: str, *args: Any) -> None:
+            pass
+
+    return Handler
+
+
+def serve(fake_youtube: FakeYoutube, port: int = 0) -> ThreadingHTTPServer:
+    """Starts the server in a daemon thread (port 0 picks a free one)."""
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(fake_youtube))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--videos', type=int, default=200,
+                        help='number of the videos of each channel')
+    parser.add_argument('--latency_ms', type=float, default=0.0)
+    parser.add_argument('--error_rate', type=float, default=0.0)
+    parser.add_argument('--rate_429', type=float, default=0.0)
+    params = parser.parse_args()
+
+    fake_youtube = FakeYoutube(params.videos, latency=params.latency_ms / 1000,
+                               error_rate=params.error_rate, rate_429=params.rate_429)
+    server = serve(fake_youtube, params.port)
+    print('serving on http://127.0.0.1:{}/'.format(server.server_address[1]), file=sys.stderr)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""Compares reloading all of the data into postgresql with applying only the changes.
+
+It needs a local postgresql, and writes into the tables `bench_videos` and `bench_captions`
+(dropped at the end). The row counts are checked after each load.
+
+usage: python benchmarks/postgres_load.py --dsn 'dbname=test' [--videos 2000]
+           [--captions_per_video 300] [--changed 20]
+"""
+
+from logging import getLogger, basicConfig, WARNING
+from pathlib import Path
+import argparse
+import datetime
+import random
+import sys
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from movie_and_captions.data import Data, VideoDatum, DataDelta  # noqa: E402
+from movie_and_captions.postgres_loader import PostgresLoader  # noqa: E402
+
+
+def make_video_datum(index: int, caption_num: int, revision: int = 0) -> VideoDatum:
+    rng = random.Random('{}/{}'.format(index, revision))
+    published = (datetime.datetime(2018, 1, 1, tzinfo=datetime.timezone.utc)
+                 + datetime.timedelta(hours=12 * index))
+    augmented_captions = []
+    milliseconds = 0
+    for _ in range(caption_num):
+        begin = milliseconds + rng.randint(0, 500)
+        end = begin + rng.randint(800, 4000)
+        milliseconds = end % (24 * 60 * 60 * 1000 - 5000)
+        content = 'キャプション{}の{}番目'.format(index, rng.randint(0, 10 ** 6))
+        augmented_captions.append(dict(
+            begin=(datetime.datetime.min + datetime.timedelta(milliseconds=begin)).time(),
+            end=(datetime.datetime.min + datetime.timedelta(milliseconds=end)).time(),
+            content=content, short_title=content[:12], yomi='きゃぷしょん'))
+    return dict(
+        video_info=dict(video_id='video{:07d}'.format(index), title='動画 #{}'.format(index),
+                        published=published),
+        caption_info=dict(caption_id='caption{:07d}'.format(index), name='',
+                          last_updated=published + datetime.timedelta(days=revision),
+                          language='ja', track_kind='standard'),
+        captions=[],
+        augmented_captions=augmented_captions,
+        augmentation_info=dict(version=1, last_updated=published))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dsn', required=True)
+    parser.add_argument('--videos', type=int, default=2000)
+    parser.add_argument('--captions_per_video', type=int, default=300)
+    parser.add_argument('--changed', type=int, default=20,
+                        help='number of each of the added, updated and removed videos')
+    params = parser.parse_args()
+    basicConfig(level=WARNING)
+
+    data: Data = [make_video_datum(index, params.captions_per_video)
+                  for index in range(params.videos)]
+    delta = DataDelta(
+        added=[make_video_datum(params.videos + index, params.captions_per_video)
+               for index in range(params.changed)],
+        updated=[make_video_datum(index, params.captions_per_video, revision=1)
+                 for index in range(params.changed, params.changed * 2)],
+        removed=['video{:07d}'.format(index) for index in range(params.changed)])
+    expected_videos = params.videos
+    expected_captions = expected_videos * params.captions_per_video
+
+    loader = PostgresLoader(params.dsn, getLogger('PostgresLoader'),
+                            videos_table='bench_videos', captions_table='bench_captions')
+    try:
+        loader.create_tables()
+        start = time.perf_counter()
+        loader.replace_all(data)
+        reload_seconds = time.perf_counter() - start
+        assert loader.count() == (expected_videos, expected_captions), loader.count()
+
+        start = time.perf_counter()
+        loader.apply(delta)
+        delta_seconds = time.perf_counter() - start
+        assert loader.count() == (expected_videos, expected_captions), loader.count()
+        # applying the same changes again changes nothing
+        loader.apply(delta)
+        assert loader.count() == (expected_videos, expected_captions), loader.count()
+
+        print('full reload of {} videos: {:.2f} s'.format(params.videos, reload_seconds))
+        print('delta of {} added, {} updated and {} removed: {:.2f} s ({:.0f}x faster)'.format(
+            len(delta.added), len(delta.updated), len(delta.removed), delta_seconds,
+            reload_seconds / delta_seconds))
+    finally:
+        loader.drop_tables()
+        loader.close()
+
+
+if __name__ == '__main__':
+    main()
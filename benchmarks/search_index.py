@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""Measures building, updating and querying the search index, against scanning the data.
+
+usage: python benchmarks/search_index.py [--videos 1000] [--captions_per_video 300]
+           [--changed 10]
+"""
+
+from pathlib import Path
+import argparse
+import copy
+import datetime
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from fake_youtube_server import PHRASES  # noqa: E402
+from movie_and_captions.data import Data, VideoDatum, diff_data  # noqa: E402
+from movie_and_captions.search_index import SearchIndex, normalize  # noqa: E402
+
+QUERIES = [('こんにちは', False), ('ゲーム', False), ('おやすみ', True), ('ハイ', False),
+           ('すごい', True), ('か', False), ('また明日', False)]
+
+
+def make_video_datum(index: int, caption_num: int) -> VideoDatum:
+    rng = random.Random(index)
+    augmented_captions = []
+    for i in range(caption_num):
+        content = ''.join(rng.choice(PHRASES) for _ in range(rng.randint(1, 4)))
+        begin = (datetime.datetime.min + datetime.timedelta(seconds=2 * i)).time()
+        augmented_captions.append(dict(begin=begin, end=begin, content=content,
+                                       short_title=content[:12], yomi=normalize(content)))
+    return dict(video_info=dict(video_id='video{:07d}'.format(index)),
+                caption_info=dict(last_updated=index),
+                augmented_captions=augmented_captions)
+
+
+def scan(data: Data, query: str, prefix: bool) -> int:
+    # what the downstream did without the index (with the texts normalized beforehand)
+    normalized_query = normalize(query)
+    hit_num = 0
+    for video_datum in data:
+        for caption in video_datum['augmented_captions']:
+            texts = [caption['normalized_content'], caption['yomi']]  # type: ignore
+            if prefix:
+                hit_num += any(text.startswith(normalized_query) for text in texts)
+            else:
+                hit_num += any(normalized_query in text for text in texts)
+    return hit_num
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--videos', type=int, default=1000)
+    parser.add_argument('--captions_per_video', type=int, default=300)
+    parser.add_argument('--changed', type=int, default=10)
+    params = parser.parse_args()
+
+    data = [make_video_datum(index, params.captions_per_video)
+            for index in range(params.videos)]
+    with tempfile.TemporaryDirectory() as directory:
+        search_index = SearchIndex(Path(directory))
+        start = time.perf_counter()
+        search_index.rebuild(data)
+        print('build: {:.2f} s for {} captions, {:.1f} MB'.format(
+            time.perf_counter() - start, params.videos * params.captions_per_video,
+            sum(os.path.getsize(os.path.join(directory, name))
+                for name in os.listdir(directory)) / 1024 / 1024))
+
+        new_data = copy.copy(data)
+        for index in range(params.changed):
+            new_data[index] = make_video_datum(params.videos + index, params.captions_per_video)
+        delta = diff_data(data, new_data)
+        start = time.perf_counter()
+        search_index.update(delta)
+        print('update: {:.3f} s for {} added and {} removed videos'.format(
+            time.perf_counter() - start, len(delta.added), len(delta.removed)))
+
+        for video_datum in new_data:
+            for caption in video_datum['augmented_captions']:
+                caption['normalized_content'] = normalize(caption['content'])  # type: ignore
+        for query, prefix in QUERIES:
+            start = time.perf_counter()
+            hits = search_index.search(query, prefix=prefix)
+            index_seconds = time.perf_counter() - start
+            start = time.perf_counter()
+            scanned_hit_num = scan(new_data, query, prefix)
+            scan_seconds = time.perf_counter() - start
+            assert len(hits) == scanned_hit_num
+            print('{:8s} {:9s} {:7d} hits: index {:8.2f} ms, scan {:8.2f} ms'.format(
+                query, 'prefix' if prefix else 'substring', len(hits), index_seconds * 1000,
+                scan_seconds * 1000))
+        search_index.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""Measures the startup time of the steps before the first api request, in fresh processes.
+
+usage: python benchmarks/startup.py [--repeat 5] [--network]
+"""
+
+from pathlib import Path
+import argparse
+import subprocess
+import sys
+import time
+
+
+REPOSITORY_ROOT = Path(__file__).resolve().parents[1]
+
+CASES = [
+    ('python only', 'pass'),
+    ('import main', 'import main'),
+    ('eager imports (before)',
+     'import main, googleapiclient.discovery, requests, MeCab'),
+    ('build service (cached document)',
+     'from movie_and_captions.authentication import load_discovery_document\n'
+     'import googleapiclient.discovery\n'
+     'googleapiclient.discovery.build_from_document(load_discovery_document(fetch=False),\n'
+     '                                              developerKey="dummy")'),
+    ('CaptionWithMecab()',
+     'from movie_and_captions.caption_with_mecab import CaptionWithMecab\n'
+     'CaptionWithMecab()'),
+    ('CaptionWithMecab() + taggers',
+     'from movie_and_captions.caption_with_mecab import CaptionWithMecab\n'
+     'CaptionWithMecab()._build_taggers()'),
+]
+
+NETWORK_CASES = [
+    ('build service (network, before)',
+     'import googleapiclient.discovery\n'
+     'googleapiclient.discovery.build("youtube", "v3", developerKey="dummy",\n'
+     '                                cache_discovery=False)'),
+]
+
+
+def measure(code: str, repeat: int) -> float:
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], cwd=str(REPOSITORY_ROOT), check=True)
+        seconds.append(time.perf_counter() - start)
+    return min(seconds)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--network', action='store_true',
+                        help='also measure fetching the discovery document over the network')
+    params = parser.parse_args()
+
+    cases = CASES + (NETWORK_CASES if params.network else [])
+    for name, code in cases:
+        seconds = measure(code, params.repeat)
+        print('{:34s} {:8.1f} ms'.format(name, seconds * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""Measures the whole sync of a synthetic channel against the local fake youtube server.
+
+Reports videos/sec, requests and quota per video, peak RSS and MeCab cues/sec,
+without touching the real youtube.
+
+usage: python benchmarks/throughput.py [--videos 200] [--workers 8] [--mecab_workers 1]
+           [--latency_ms 50] [--error_rate 0.01] [--rate_429 0.01] [--pipeline] [--rerun]
+"""
+
+from logging import getLogger, basicConfig, ERROR
+from pathlib import Path
+from typing import Dict, Any, Tuple
+import argparse
+import json
+import multiprocessing
+import resource
+import sys
+import time
+import urllib.request
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from fake_youtube_server import FakeYoutube, serve  # noqa: E402
+from movie_and_captions.authentication import (  # noqa: E402
+    build_youtube_service, load_discovery_document)
+from movie_and_captions.youtube_api import YoutubeAPI, DirtyYoutubeAPI  # noqa: E402
+from movie_and_captions.caption_updater import CaptionUpdater  # noqa: E402
+from movie_and_captions.caption_with_mecab import CaptionWithMecab  # noqa: E402
+from movie_and_captions.pipeline import CaptionPipeline  # noqa: E402
+from movie_and_captions.metrics import Metrics  # noqa: E402
+
+
+CHANNEL_ID = 'UCbenchmark0000000000000'
+
+
+def _run_server(fake_youtube: FakeYoutube, port_queue: multiprocessing.Queue) -> None:
+    server = serve(fake_youtube)
+    port_queue.put(server.server_address[1])
+    while True:
+        time.sleep(3600)
+
+
+def start_server(fake_youtube: FakeYoutube) -> Tuple[multiprocessing.Process, str]:
+    # in another process, not to share the GIL with the client
+    port_queue: multiprocessing.Queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run_server, args=(fake_youtube, port_queue),
+                                      daemon=True)
+    process.start()
+    return process, 'http://127.0.0.1:{}/'.format(port_queue.get())
+
+
+def get_stats(root_url: str) -> Dict[str, Any]:
+    with urllib.request.urlopen(root_url + 'stats') as response:
+        return json.loads(response.read().decode('utf-8'))
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on linux; the children are the MeCab workers
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+
+
+def report(name: str, videos: int, seconds: float, stats_before: Dict[str, Any],
+           stats_after: Dict[str, Any]) -> None:
+    requests = {method_id: count - stats_before['requests'].get(method_id, 0)
+                for method_id, count in stats_after['requests'].items()}
+    request_num = sum(requests.values())
+    quota = stats_after['quota'] - stats_before['quota']
+    per_video = max(videos, 1)
+    print('{}: {} videos in {:.2f} s, {:.1f} videos/sec'.format(
+        name, videos, seconds, videos / seconds))
+    print('    {} requests ({:.2f} / video), {} quota units ({:.1f} / video)'.format(
+        request_num, request_num / per_video, quota, quota / per_video))
+    for method_id, count in sorted(requests.items()):
+        if count > 0:
+            print('    {:32s} {:6d}'.format(method_id, count))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--videos', type=int, default=200)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--mecab_workers', type=int, default=1)
+    parser.add_argument('--augmentation_cache_size', type=int, default=100000)
+    parser.add_argument('--latency_ms', type=float, default=50.0)
+    parser.add_argument('--error_rate', type=float, default=0.0)
+    parser.add_argument('--rate_429', type=float, default=0.0)
+    parser.add_argument('--pipeline', action='store_true')
+    parser.add_argument('--rerun', action='store_true',
+                        help='also measure the second run, where nothing is updated')
+    params = parser.parse_args()
+    basicConfig(level=ERROR)
+    logger = getLogger(__name__)
+
+    fake_youtube = FakeYoutube(params.videos, latency=params.latency_ms / 1000,
+                               error_rate=params.error_rate, rate_429=params.rate_429)
+    _, root_url = start_server(fake_youtube)
+
+    youtube = build_youtube_service(load_discovery_document(fetch=False),
+                                    api_root_url=root_url, api_key='dummy')
+    metrics = Metrics()
+    youtube_api = YoutubeAPI(youtube, logger, metrics=metrics)
+    dirty_youtube_api = DirtyYoutubeAPI(logger, pool_size=params.workers, backoff_base=0.05,
+                                        timedtext_url=root_url + 'api/timedtext',
+                                        metrics=metrics)
+    caption_updater = CaptionUpdater(youtube_api, dirty_youtube_api, logger,
+                                     max_workers=params.workers)
+    caption_with_mecab = CaptionWithMecab(logger, max_workers=params.mecab_workers,
+                                          cache_size=params.augmentation_cache_size,
+                                          metrics=metrics)
+
+    stats_before = get_stats(root_url)
+    start = time.perf_counter()
+    if params.pipeline:
+        data = CaptionPipeline(caption_updater, caption_with_mecab, logger).do(CHANNEL_ID, [])
+        synced = time.perf_counter()
+        augmented = synced
+    else:
+        data = caption_updater.do(CHANNEL_ID, [])
+        synced = time.perf_counter()
+        data = caption_with_mecab.do(data)
+        augmented = time.perf_counter()
+    report('first run', len(data), augmented - start, stats_before, get_stats(root_url))
+
+    cue_num = sum(len(video_datum['captions']) for video_datum in data)
+    if params.pipeline:
+        print('    {} cues (download and MeCab are overlapped)'.format(cue_num))
+    else:
+        print('    download {:.2f} s, MeCab {:.2f} s for {} cues ({:.0f} cues/sec)'.format(
+            synced - start, augmented - synced, cue_num, cue_num / (augmented - synced)))
+    print('    peak RSS {:.1f} MB'.format(peak_rss_mb()))
+    # the sums of the stages in the threads can exceed the wall time
+    for stage, histogram in metrics.stages().items():
+        print('    {:14s} {:8.2f} s in {:5d} calls, p90 {:.3f} s'.format(
+            stage, histogram.sum, histogram.count, histogram.quantile(0.9)))
+
+    if params.rerun:
+        stats_before = get_stats(root_url)
+        start = time.perf_counter()
+        data = caption_with_mecab.do(caption_updater.do(CHANNEL_ID, data))
+        report('second run', len(data), time.perf_counter() - start, stats_before,
+               get_stats(root_url))
+    caption_with_mecab.close()
+
+
+if __name__ == '__main__':
+    main()
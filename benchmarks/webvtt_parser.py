@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""Compares the native WebVTT parser with the former webvtt-py based one.
+
+usage: python benchmarks/webvtt_parser.py [--hours 3] [--repeat 5]
+"""
+
+from pathlib import Path
+from typing import List
+import argparse
+import datetime
+import random
+import re
+import sys
+import timeit
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import webvtt  # noqa: E402
+
+from movie_and_captions.models import Caption  # noqa: E402
+from movie_and_captions.youtube_api.treat_webvtt import (  # noqa: E402
+    webvtt_string_to_parsed, webvtt_chunks_to_parsed)
+
+
+TIMESTAMP_PATTERN = re.compile(r'^(\d+)?:?(\d{2}):(\d{2})[.,](\d{3})$')
+
+
+def webvtt_py_string_to_parsed(webvtt_string: str) -> List[Caption]:
+    # the implementation before the native parser
+    def timestamp_to_time(timestamp: str) -> datetime.time:
+        m = TIMESTAMP_PATTERN.match(timestamp)
+        assert m is not None
+        hours, minutes, seconds, milisecs = m.groups()
+        if hours is None:
+            hours = '0'
+        return datetime.time(int(hours), int(minutes), int(seconds), int(milisecs) * 1000)
+
+    parser = webvtt.parsers.WebVTTParser()
+    lines = webvtt_string.split('\n')
+    parser._validate(lines)
+    parser._parse(lines)
+    return [Caption(timestamp_to_time(caption.start), timestamp_to_time(caption.end),
+                    caption.text)
+            for caption in parser.captions]
+
+
+def make_webvtt_string(hours: float, seed: int = 0) -> str:
+    random_generator = random.Random(seed)
+    phrases = ['こんにちは！', 'シロです。', '(笑)', '[音楽]', '<c>えっ</c>？',
+               'ばあちゃる「はいはいはい」', '今日はいい天気ですね\nお散歩しましょう', 'ふふっ']
+    lines = ['WEBVTT', 'Kind: captions', 'Language: ja', '']
+    milliseconds = 0
+    index = 0
+    while milliseconds < hours * 3600 * 1000:
+        begin = milliseconds
+        end = begin + random_generator.randint(500, 4000)
+        milliseconds = end + random_generator.randint(0, 1000)
+        index += 1
+        if index % 50 == 0:
+            lines.extend(['NOTE checkpoint {}'.format(index), ''])
+        if index % 7 == 0:
+            lines.append(str(index))
+        lines.append('{} --> {} align:start position:0%'.format(
+            _format(begin), _format(end)))
+        lines.append(random_generator.choice(phrases))
+        lines.append('')
+    return '\n'.join(lines)
+
+
+def _format(milliseconds: int) -> str:
+    seconds, milliseconds = divmod(milliseconds, 1000)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{:02d}:{:02d}:{:02d}.{:03d}'.format(hours, minutes, seconds, milliseconds)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--hours', type=float, default=3.0)
+    parser.add_argument('--repeat', type=int, default=5)
+    params = parser.parse_args()
+
+    webvtt_string = make_webvtt_string(params.hours)
+    chunks = [webvtt_string[i:i + 64 * 1024] for i in range(0, len(webvtt_string), 64 * 1024)]
+    expected = webvtt_py_string_to_parsed(webvtt_string)
+    assert webvtt_string_to_parsed(webvtt_string) == expected
+    assert webvtt_chunks_to_parsed(chunks) == expected
+    print('{} cues, {} bytes, outputs are identical'.format(
+        len(expected), len(webvtt_string.encode('utf-8'))))
+
+    cases = [('webvtt-py', lambda: webvtt_py_string_to_parsed(webvtt_string)),
+             ('native (string)', lambda: webvtt_string_to_parsed(webvtt_string)),
+             ('native (chunks)', lambda: webvtt_chunks_to_parsed(chunks))]
+    for name, function in cases:
+        seconds = min(timeit.repeat(function, number=1, repeat=params.repeat))
+        print('{:16s} {:8.1f} ms  {:10.0f} cues/sec'.format(
+            name, seconds * 1000, len(expected) / seconds))
+
+
+if __name__ == '__main__':
+    main()
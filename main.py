@@ -2,16 +2,26 @@
 
 from pathlib import Path
 from logging import getLogger, basicConfig, DEBUG, INFO, WARNING
-from typing import List
+from typing import List, Optional
 import argparse
+import datetime
 import pickle
+import signal
 import sys
 
-from movie_and_captions.authentication import build_youtube_service
-from movie_and_captions.youtube_api import YoutubeAPI, DirtyYoutubeAPI
+from movie_and_captions.authentication import build_youtube_service, load_discovery_document
+from movie_and_captions.youtube_api import YoutubeAPI, DirtyYoutubeAPI, ResponseCache, QuotaBudget
 from movie_and_captions.caption_updater import CaptionUpdater
 from movie_and_captions.caption_with_mecab import CaptionWithMecab
-from movie_and_captions.data import Data
+from movie_and_captions.caption_store import CaptionStore
+from movie_and_captions.pipeline import CaptionPipeline
+from movie_and_captions.checkpoint import CheckpointJournal
+from movie_and_captions.channel_sync import update_store, read_channel_ids, MultiChannelSync
+from movie_and_captions.daemon import CaptionDaemon
+from movie_and_captions.metrics import Metrics
+from movie_and_captions.postgres_loader import PostgresLoader
+from movie_and_captions.search_index import SearchIndex
+from movie_and_captions.data import Data, diff_data, compact_data, expand_data
 
 
 def main(args: List[str] = None) -> None:
@@ -20,36 +30,314 @@ def main(args: List[str] = None) -> None:
 
     # add params to the parser
     parser = argparse.ArgumentParser()
-    parser.add_argument('old_data', nargs='?', type=argparse.FileType('rb'), default=None)
+    parser.add_argument('old_data', nargs='?', type=argparse.FileType('rb'), default=None,
+                        help='result of the previous run '
+                        '(with --store, it is migrated into the store)')
+    parser.add_argument('--store', type=Path, default=None,
+                        help='sqlite file to keep the data in, instead of the pickle in stdout')
+    parser.add_argument('--export_pickle', action='store_true',
+                        help='with --store, also write the whole data to stdout as a pickle')
+    parser.add_argument('--compact_pickle', action='store_true',
+                        help='pack the captions of each video into a CaptionBlock in the pickle '
+                        'written to stdout (old_data can be either of them)')
     parser.add_argument('--target_channel_id', default='UCLhUvJ_wO9hOvv_yYENu4fQ')
+    parser.add_argument('--output_dir', type=Path, default=None,
+                        help='sync many channels at once, writing <channel id>.pkl '
+                        '(or .sqlite3) of each channel in this directory')
+    parser.add_argument('--target_channel_ids', nargs='+', default=[],
+                        help='with --output_dir, the channels to sync')
+    parser.add_argument('--channel_file', type=argparse.FileType('r'), default=None,
+                        help='with --output_dir, file listing the channels to sync, one per line')
+    parser.add_argument('--output_format', choices=['pickle', 'sqlite'], default='pickle',
+                        help='with --output_dir, the format of the file of each channel')
+    parser.add_argument('--channel_workers', type=int, default=4,
+                        help='with --output_dir, number of channels synced concurrently')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of videos fetched from youtube concurrently')
+    parser.add_argument('--mecab_workers', type=int, default=1,
+                        help='number of processes to augment captions with MeCab')
+    parser.add_argument('--augmentation_cache_size', type=int, default=100000,
+                        help='number of augmented caption texts memoized in memory (0 to disable; '
+                        '--augmentation_cache_path is still used)')
+    parser.add_argument('--augmentation_cache_path', type=Path, default=None,
+                        help='sqlite file to share the augmented caption texts across runs')
+    parser.add_argument('--incremental', action='store_true',
+                        help='stop scanning the uploads playlist at the videos known in old_data '
+                        '(run without this flag periodically to catch deleted videos)')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='augment each video as soon as its captions are downloaded, '
+                        'overlapping the downloads with MeCab')
+    parser.add_argument('--max_in_flight', type=int, default=16,
+                        help='with --pipeline, max number of videos downloaded or augmented '
+                        'but not yet written')
+    parser.add_argument('--delta', type=Path, default=None,
+                        help='pickle file to write the videos added, updated and removed since '
+                        'old_data into (not with --store or --output_dir)')
+    parser.add_argument('--postgres', default=None, metavar='DSN',
+                        help='load the changes since old_data into this postgresql database '
+                        '(not with --store or --output_dir)')
+    parser.add_argument('--postgres_reload', action='store_true',
+                        help='with --postgres, replace all the rows instead of the changes')
+    parser.add_argument('--search_index', type=Path, default=None,
+                        help='directory of the search index of the captions, updated with the '
+                        'changes since old_data (not with --store or --output_dir)')
+    parser.add_argument('--journal', type=Path, default=None,
+                        help='file to record each downloaded video, removed when the run succeeds')
+    parser.add_argument('--resume', action='store_true',
+                        help='with --journal, skip the videos recorded by the interrupted run')
+    parser.add_argument('--daemon', action='store_true',
+                        help='with --store, keep running and poll the channel at an adaptive '
+                        'interval (stop with Ctrl-C or SIGTERM)')
+    parser.add_argument('--poll_min_minutes', type=float, default=5.0,
+                        help='with --daemon, the interval right after something is updated')
+    parser.add_argument('--poll_max_minutes', type=float, default=360.0,
+                        help='with --daemon, the longest interval while nothing is updated')
+    parser.add_argument('--recheck_days', type=float, default=7.0,
+                        help='with --daemon, check the captions of the videos published '
+                        'in these days again')
+    parser.add_argument('--full_scan_hours', type=float, default=24.0,
+                        help='with --daemon, scan the whole uploads playlist in this interval '
+                        'to catch the deleted videos')
+    parser.add_argument('--daily_quota', type=int, default=None,
+                        help='quota units to use in a day (10000 by default on youtube); '
+                        'the videos over the budget are checked in the next runs')
+    parser.add_argument('--quota_state', type=Path, default=None,
+                        help='json file to keep the quota used today across runs')
+    parser.add_argument('--timedtext_rate', type=float, default=None,
+                        help='max number of caption downloads per second')
+    parser.add_argument('--discovery_cache', type=Path, default=None,
+                        help='file to cache the discovery document of the youtube api '
+                        '(~/.cache/movie_and_captions/youtube.v3.json by default)')
+    parser.add_argument('--discovery_max_age_days', type=float, default=7.0,
+                        help='refetch the discovery document after these days')
+    parser.add_argument('--offline_discovery', action='store_true',
+                        help='never fetch the discovery document; use the cached or bundled one')
+    parser.add_argument('--api_root_url', default=None,
+                        help='root url of the youtube data api (https://youtube.googleapis.com/ '
+                        'by default), to use a stand-in server')
+    parser.add_argument('--timedtext_url', default='https://www.youtube.com/api/timedtext')
+    parser.add_argument('--metrics_json', type=Path, default=None,
+                        help='json file to write the timings and counters of the run into')
+    parser.add_argument('--metrics_prometheus', type=Path, default=None,
+                        help='file to write the metrics into in the prometheus text format '
+                        '(for the textfile collector of node_exporter)')
+    parser.add_argument('--profile', type=Path, default=None,
+                        help='profile the api calls, the downloads and MeCab with cProfile, and '
+                        'dump the statistics into this file (MeCab only with --mecab_workers 1)')
+    parser.add_argument('--cache_dir', type=Path, default=None,
+                        help='directory to cache api responses across runs')
+    parser.add_argument('--cache_max_mb', type=int, default=256)
+    parser.add_argument('--cache_max_age_days', type=int, default=30)
 
     # get params from arguments
     if args is None:
         params = parser.parse_args()
     else:
         params = parser.parse_args(args)
-    old_data: Data
-    if params.old_data is not None:
-        # note: this is BAD because pickle.load is not secure for outside binary file!
-        old_data = pickle.load(params.old_data)
-    else:
-        old_data = []
     target_channel_id: str = params.target_channel_id
+    workers: int = params.workers
+    incremental: bool = params.incremental
+    response_cache: Optional[ResponseCache] = None
+    if params.cache_dir is not None:
+        response_cache = ResponseCache(params.cache_dir,
+                                       max_bytes=params.cache_max_mb * 1024 * 1024,
+                                       max_age=datetime.timedelta(days=params.cache_max_age_days),
+                                       logger=logger.getChild('ResponseCache'))
+
+    channel_ids: List[str] = list(params.target_channel_ids)
+    if params.channel_file is not None:
+        channel_ids += read_channel_ids(params.channel_file)
+    if params.output_dir is not None:
+        if len(channel_ids) == 0:
+            channel_ids = [target_channel_id]
+        if params.old_data is not None or params.store is not None or params.journal is not None:
+            parser.error('old_data, --store and --journal cannot be used with --output_dir '
+                         '(the files of each channel are in the directory)')
+    elif len(channel_ids) > 0:
+        parser.error('--target_channel_ids and --channel_file require --output_dir')
+    if ((params.delta is not None or params.postgres is not None
+         or params.search_index is not None)
+            and (params.store is not None or params.output_dir is not None)):
+        parser.error('--delta, --postgres and --search_index cannot be used with --store or '
+                     '--output_dir')
+    if params.postgres_reload and params.postgres is None:
+        parser.error('--postgres_reload requires --postgres')
+    if params.daemon and (params.store is None or params.journal is not None):
+        parser.error('--daemon requires --store, and cannot be used with --journal')
+
+    journal: Optional[CheckpointJournal] = None
+    if params.journal is not None:
+        journal = CheckpointJournal(params.journal, resume=params.resume,
+                                    logger=logger.getChild('CheckpointJournal'))
+    elif params.resume and params.output_dir is None:
+        parser.error('--resume requires --journal')
+
+    quota_budget: Optional[QuotaBudget] = None
+    if params.daily_quota is not None:
+        quota_budget = QuotaBudget(params.daily_quota, params.quota_state,
+                                   logger.getChild('QuotaBudget'))
+        print('quota: {} of {} units are left today'
+              .format(quota_budget.remaining, quota_budget.daily_limit), file=sys.stderr)
+    elif params.quota_state is not None:
+        parser.error('--quota_state requires --daily_quota')
+
+    # written at the end of the run (and after each poll of the daemon)
+    metrics = Metrics(params.metrics_json, params.metrics_prometheus, params.profile,
+                      logger.getChild('Metrics'))
 
     # build youtube api service and use it to get captions
-    youtube = build_youtube_service()
-    youtube_api = YoutubeAPI(youtube, logger.getChild('YoutubeAPI'))
-    dirty_youtube_api = DirtyYoutubeAPI(logger.getChild('DirtyYoutubeAPI'))
+    discovery_document = load_discovery_document(
+        params.discovery_cache, datetime.timedelta(days=params.discovery_max_age_days),
+        fetch=not params.offline_discovery, logger=logger.getChild('discovery'))
+    youtube = build_youtube_service(discovery_document, api_root_url=params.api_root_url)
+    youtube_api = YoutubeAPI(youtube, logger.getChild('YoutubeAPI'), response_cache,
+                             quota_budget, metrics)
+    dirty_youtube_api = DirtyYoutubeAPI(logger.getChild('DirtyYoutubeAPI'), pool_size=workers,
+                                        requests_per_second=params.timedtext_rate,
+                                        timedtext_url=params.timedtext_url, metrics=metrics)
     caption_updater = CaptionUpdater(youtube_api, dirty_youtube_api,
-                                     logger.getChild('CaptionUpdater'))
-    caption_with_mecab = CaptionWithMecab(logger.getChild('CaptionWithMecab'))
+                                     logger.getChild('CaptionUpdater'), max_workers=workers,
+                                     journal=journal)
+    caption_with_mecab = CaptionWithMecab(logger.getChild('CaptionWithMecab'),
+                                          max_workers=params.mecab_workers,
+                                          cache_size=params.augmentation_cache_size,
+                                          cache_path=params.augmentation_cache_path,
+                                          metrics=metrics)
+    pipeline: Optional[CaptionPipeline] = None
+    if params.pipeline:
+        pipeline = CaptionPipeline(caption_updater, caption_with_mecab,
+                                   logger.getChild('CaptionPipeline'),
+                                   max_in_flight=params.max_in_flight)
+
+    failed_channel_ids: List[str] = []
+    try:
+        # do main
+        if params.output_dir is not None:
+            multi_channel_sync = MultiChannelSync(
+                youtube_api, dirty_youtube_api, caption_with_mecab, params.output_dir,
+                logger.getChild('MultiChannelSync'), max_workers=workers,
+                channel_workers=params.channel_workers, output_format=params.output_format,
+                incremental=incremental, resume=params.resume, use_pipeline=params.pipeline,
+                max_in_flight=params.max_in_flight)
+            errors = multi_channel_sync.run(channel_ids)
+            failed_channel_ids = [channel_id for channel_id, error in errors.items()
+                                  if error is not None]
+            print('{} of {} channels are synced'
+                  .format(len(channel_ids) - len(failed_channel_ids), len(channel_ids)),
+                  file=sys.stderr)
+            if len(failed_channel_ids) > 0:
+                print('failed: {}'.format(' '.join(failed_channel_ids)), file=sys.stderr)
+        elif params.daemon:
+            store = CaptionStore(params.store)
+            if params.old_data is not None:
+                migrated_num = store.migrate_from_pickle(params.old_data)
+                logger.warning('{} videos are migrated into {}'.format(migrated_num, params.store))
+            daemon = CaptionDaemon(
+                caption_updater, caption_with_mecab, store, target_channel_id,
+                logger.getChild('CaptionDaemon'), pipeline=pipeline, quota_budget=quota_budget,
+                min_interval=datetime.timedelta(minutes=params.poll_min_minutes),
+                max_interval=datetime.timedelta(minutes=params.poll_max_minutes),
+                recheck_period=datetime.timedelta(days=params.recheck_days),
+                full_scan_interval=datetime.timedelta(hours=params.full_scan_hours),
+                metrics=metrics)
+            signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stop())
+            try:
+                daemon.run()
+            except KeyboardInterrupt:
+                logger.warning('stopped')
+            store.close()
+        elif params.store is None:
+            old_data: Data
+            if params.old_data is not None:
+                # note: this is BAD because pickle.load is not secure for outside binary file!
+                old_data = expand_data(pickle.load(params.old_data))
+            else:
+                old_data = []
+            if pipeline is None:
+                data = caption_updater.do(target_channel_id, old_data, incremental=incremental)
+                data = caption_with_mecab.do(data)
+            else:
+                data = pipeline.do(target_channel_id, old_data, incremental=incremental)
+
+            # write to stdout
+            sys.stdout.buffer.write(pickle.dumps(compact_data(data) if params.compact_pickle
+                                                 else data))
+            sys.stdout.buffer.flush()
+
+            if (params.delta is not None or params.postgres is not None
+                    or params.search_index is not None):
+                delta = diff_data(old_data, data)
+                print('{} videos are added, {} updated and {} removed'
+                      .format(len(delta.added), len(delta.updated), len(delta.removed)),
+                      file=sys.stderr)
+                if params.delta is not None:
+                    # a plain dict, so that it is loaded without this package
+                    with params.delta.open('wb') as f:
+                        pickle.dump(delta._asdict(), f)
+                if params.postgres is not None:
+                    postgres_loader = PostgresLoader(params.postgres,
+                                                     logger.getChild('PostgresLoader'))
+                    try:
+                        postgres_loader.create_tables()
+                        if params.postgres_reload:
+                            postgres_loader.replace_all(data)
+                        else:
+                            postgres_loader.apply(delta)
+                    finally:
+                        postgres_loader.close()
+                if params.search_index is not None:
+                    search_index = SearchIndex(params.search_index,
+                                               logger.getChild('SearchIndex'))
+                    try:
+                        # the index is assumed to be built from old_data
+                        if search_index.is_empty or len(old_data) == 0:
+                            search_index.rebuild(data)
+                        else:
+                            search_index.update(delta)
+                    finally:
+                        search_index.close()
+        else:
+            store = CaptionStore(params.store)
+            if params.old_data is not None:
+                migrated_num = store.migrate_from_pickle(params.old_data)
+                logger.warning('{} videos are migrated into {}'.format(migrated_num, params.store))
+            update_store(store, caption_updater, caption_with_mecab, target_channel_id,
+                         incremental, pipeline)
+            if params.export_pickle:
+                exported_data = store.to_data()
+                sys.stdout.buffer.write(pickle.dumps(compact_data(exported_data)
+                                                     if params.compact_pickle else exported_data))
+            store.close()
+    finally:
+        caption_with_mecab.close()
+        # keep the quota used so far even if the run is interrupted
+        if quota_budget is not None:
+            quota_budget.save()
+            print('quota: {} units used today'.format(quota_budget.used), file=sys.stderr)
+        # also for the failed runs, to see where they stopped
+        metrics.save()
+
+    # all of the journaled videos are in the output now
+    if journal is not None:
+        journal.finish()
 
-    # do main
-    data = caption_updater.do(target_channel_id, old_data)
-    data = caption_with_mecab.do(data)
+    if response_cache is not None:
+        response_cache.prune()
+        stats = response_cache.stats
+        print('response cache: {} hits, {} misses, {} quota units saved'
+              .format(stats.hits, stats.misses, stats.quota_saved), file=sys.stderr)
+    if params.augmentation_cache_size > 0 or params.augmentation_cache_path is not None:
+        augmentation_stats = caption_with_mecab.cache_stats
+        print('augmentation cache: {} hits, {} disk hits, {} misses (hit rate {:.1%})'
+              .format(augmentation_stats.hits, augmentation_stats.disk_hits,
+                      augmentation_stats.misses, augmentation_stats.hit_rate), file=sys.stderr)
+    for stage, histogram in metrics.stages().items():
+        print('{}: {} times, {:.2f} s in total (p50 {:.3f} s, p90 {:.3f} s, max {:.3f} s)'
+              .format(stage, histogram.count, histogram.sum, histogram.quantile(0.5),
+                      histogram.quantile(0.9), histogram.max), file=sys.stderr)
 
-    # write to stdout
-    sys.stdout.buffer.write(pickle.dumps(data))
+    if len(failed_channel_ids) > 0:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,104 @@
+from collections import OrderedDict
+from pathlib import Path
+from typing import NamedTuple, Optional, Tuple, List, Union
+import hashlib
+import sqlite3
+
+
+# (short_title, yomi), or None if the caption has nothing to show
+AugmentationResult = Optional[Tuple[str, str]]
+
+
+class AugmentationCacheStats(NamedTuple):
+    hits: int
+    disk_hits: int
+    misses: int
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.disk_hits + self.misses
+        return (self.hits + self.disk_hits) / lookups if lookups > 0 else 0.0
+
+
+class AugmentationCache:
+    """LRU cache of the augmentation results, keyed by the hash of the normalized caption text.
+
+    If `path` is given, the results are also stored in a sqlite database shared across runs
+    (and processes). With `max_entries` of 0, only the database is used.
+    The key includes `version`, so the results made with other rules are never returned.
+    """
+
+    MISSING = object()
+
+    def __init__(
+            self,
+            version: int,
+            max_entries: int = 100000,
+            path: Optional[Path] = None
+    ) -> None:
+        assert max_entries >= 0
+        assert max_entries >= 1 or path is not None
+        self._version = version
+        self._max_entries = max_entries
+        self._entries: 'OrderedDict[bytes, AugmentationResult]' = OrderedDict()
+        self._hits = 0
+        self._disk_hits = 0
+        self._misses = 0
+        self._connection: Optional[sqlite3.Connection] = None
+        self._unsaved_entries: List[Tuple[bytes, Optional[str], Optional[str]]] = []
+        if path is not None:
+            self._connection = sqlite3.connect(str(path), timeout=60)
+            self._connection.execute('CREATE TABLE IF NOT EXISTS augmentation_results '
+                                     '(key BLOB PRIMARY KEY, short_title TEXT, yomi TEXT)')
+            self._connection.commit()
+
+    def key(self, normalized_text: str) -> bytes:
+        return hashlib.blake2b('{}\0{}'.format(self._version, normalized_text).encode('utf-8'),
+                               digest_size=16).digest()
+
+    def get(self, key: bytes) -> Union[AugmentationResult, object]:
+        """Returns the cached result, or `AugmentationCache.MISSING` if it is not cached."""
+        result = self._entries.get(key, self.MISSING)
+        if result is not self.MISSING:
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return result
+        if self._connection is not None:
+            row = self._connection.execute(
+                'SELECT short_title, yomi FROM augmentation_results WHERE key = ?',
+                (key,)).fetchone()
+            if row is not None:
+                result = None if row[0] is None else (row[0], row[1])
+                self._put_in_memory(key, result)
+                self._disk_hits += 1
+                return result
+        self._misses += 1
+        return self.MISSING
+
+    def put(self, key: bytes, result: AugmentationResult) -> None:
+        self._put_in_memory(key, result)
+        if self._connection is not None:
+            if result is None:
+                self._unsaved_entries.append((key, None, None))
+            else:
+                self._unsaved_entries.append((key, result[0], result[1]))
+
+    def _put_in_memory(self, key: bytes, result: AugmentationResult) -> None:
+        if self._max_entries == 0:
+            return
+        self._entries[key] = result
+        if len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+    def save(self) -> None:
+        if self._connection is None or not self._unsaved_entries:
+            return
+        with self._connection:
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO augmentation_results VALUES (?, ?, ?)',
+                self._unsaved_entries)
+        self._unsaved_entries = []
+
+    @property
+    def stats(self) -> AugmentationCacheStats:
+        return AugmentationCacheStats(self._hits, self._disk_hits, self._misses)
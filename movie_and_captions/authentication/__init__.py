@@ -1 +1,2 @@
 from .get_youtube import build_youtube_service
+from .discovery import load_discovery_document
@@ -0,0 +1,100 @@
+from logging import getLogger, Logger
+from pathlib import Path
+from typing import Optional, Dict, Any
+import datetime
+import json
+import os
+import time
+
+
+API_SERVICE_NAME = 'youtube'
+API_VERSION = 'v3'
+DISCOVERY_URL = 'https://www.googleapis.com/discovery/v1/apis/{}/{}/rest'.format(
+    API_SERVICE_NAME, API_VERSION)
+
+
+def default_cache_path() -> Path:
+    cache_home = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+    file_name = '{}.{}.json'.format(API_SERVICE_NAME, API_VERSION)
+    return Path(cache_home) / 'movie_and_captions' / file_name
+
+
+# a copy of the document is kept in the repository, for the runs without a network at the first
+# time (the pinned google-api-python-client does not ship the documents)
+BUNDLED_DOCUMENT_PATH = Path(__file__).parent / '{}.{}.json'.format(API_SERVICE_NAME, API_VERSION)
+
+
+def _parse_document(content: str) -> Dict[str, Any]:
+    """Parses the discovery document, checking that it is the one of the expected api."""
+    document = json.loads(content)
+    if (document.get('name') != API_SERVICE_NAME or document.get('version') != API_VERSION
+            or 'revision' not in document):
+        raise ValueError('not a discovery document of {} {}'
+                         .format(API_SERVICE_NAME, API_VERSION))
+    return document
+
+
+def _read_document(path: Path) -> Optional[str]:
+    try:
+        content = path.read_text(encoding='utf-8')
+        _parse_document(content)
+        return content
+    except (OSError, ValueError):
+        return None
+
+
+def _revision(content: str) -> str:
+    # the revisions are dates like '20240101', so they are comparable as strings
+    return _parse_document(content)['revision']
+
+
+def load_discovery_document(
+        cache_path: Optional[Path] = None,
+        max_age: datetime.timedelta = datetime.timedelta(days=7),
+        timeout: float = 10.0,
+        fetch: bool = True,
+        logger: Logger = getLogger(__name__)
+) -> str:
+    """Returns the discovery document of the youtube api, fetching it only when needed.
+
+    The document is cached in `cache_path` and refetched when the cache gets older than
+    `max_age`. If it cannot be fetched (offline, for example) or `fetch` is False, the newer
+    one of the (stale) cache and the document bundled in this package is used. A fetched
+    document older than the cached one is not used, and the cached one is kept.
+    """
+    if cache_path is None:
+        cache_path = default_cache_path()
+    cached_content = _read_document(cache_path)
+    if cached_content is not None:
+        age = time.time() - cache_path.stat().st_mtime
+        if age < max_age.total_seconds():
+            return cached_content
+
+    if fetch:
+        import urllib.request
+        try:
+            with urllib.request.urlopen(DISCOVERY_URL, timeout=timeout) as response:
+                content = response.read().decode('utf-8')
+            _parse_document(content)
+        except (OSError, ValueError) as error:
+            logger.warning('failed to fetch the discovery document: {}'.format(error))
+        else:
+            if cached_content is not None and _revision(content) < _revision(cached_content):
+                # keep the newer cached one, refreshed not to fetch it again until `max_age`
+                logger.warning('the fetched discovery document is older than the cached one, '
+                               'so the cached one is used')
+                os.utime(str(cache_path))
+                return cached_content
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            temporary_path = cache_path.with_name(cache_path.name + '.tmp')
+            temporary_path.write_text(content, encoding='utf-8')
+            temporary_path.replace(cache_path)
+            return content
+
+    candidates = [candidate for candidate in [cached_content,
+                                              _read_document(BUNDLED_DOCUMENT_PATH)]
+                  if candidate is not None]
+    if len(candidates) == 0:
+        raise RuntimeError('no discovery document of {} {} is available'
+                           .format(API_SERVICE_NAME, API_VERSION))
+    return max(candidates, key=_revision)
@@ -1,6 +1,12 @@
-import googleapiclient
-import googleapiclient.discovery
+from typing import Optional, TYPE_CHECKING
+import json
 import os.path
+import urllib.parse
+
+from .discovery import load_discovery_document
+
+if TYPE_CHECKING:
+    import googleapiclient.discovery
 
 
 def _read_api_key() -> str:
@@ -10,10 +16,31 @@ def _read_api_key() -> str:
     return api_key
 
 
-def build_youtube_service() -> googleapiclient.discovery.Resource:
-    api_service_name = 'youtube'
-    api_version = 'v3'
-    api_key = _read_api_key()
-    service = googleapiclient.discovery.build(api_service_name, api_version, developerKey=api_key,
-                                        cache_discovery=False)
+def build_youtube_service(
+        discovery_document: Optional[str] = None,
+        api_root_url: Optional[str] = None,
+        api_key: Optional[str] = None
+) -> 'googleapiclient.discovery.Resource':
+    """Builds the youtube api client.
+
+    `api_root_url` replaces 'https://youtube.googleapis.com/' (to use a local fake server,
+    for example), and `api_key` replaces the one in the API_KEY file.
+    """
+    # googleapiclient takes a while to import, so it is imported only when it is used
+    import googleapiclient.discovery
+
+    if discovery_document is None:
+        discovery_document = load_discovery_document()
+    if api_key is None:
+        api_key = _read_api_key()
+    if api_root_url is not None:
+        # the urls in the document are rewritten, since google-api-python-client 1.7 has
+        # no option to override the endpoint
+        document = json.loads(discovery_document)
+        document['rootUrl'] = api_root_url
+        document['baseUrl'] = urllib.parse.urljoin(api_root_url, document['servicePath'])
+        discovery_document = json.dumps(document)
+    # build from the (cached) document, not to fetch it over the network on every start
+    service = googleapiclient.discovery.build_from_document(discovery_document,
+                                                            developerKey=api_key)
     return service
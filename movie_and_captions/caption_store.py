@@ -0,0 +1,138 @@
+from collections.abc import Mapping
+from pathlib import Path
+from typing import Dict, Iterator, List, Any, Iterable, Optional, BinaryIO
+import datetime
+import json
+import pickle
+import sqlite3
+
+from movie_and_captions.data import Data, VideoDatum, expand_data
+
+
+def _json_default(obj: Any) -> Any:
+    if isinstance(obj, datetime.datetime):
+        return {'__datetime__': obj.isoformat()}
+    if isinstance(obj, datetime.time):
+        return {'__time__': obj.isoformat()}
+    raise TypeError('{} is not JSON serializable'.format(type(obj)))
+
+
+def _json_object_hook(obj: Dict[str, Any]) -> Any:
+    if len(obj) == 1:
+        if '__datetime__' in obj:
+            return datetime.datetime.fromisoformat(obj['__datetime__'])
+        if '__time__' in obj:
+            return datetime.time.fromisoformat(obj['__time__'])
+    return obj
+
+
+def dumps_json(obj: Any) -> str:
+    return json.dumps(obj, ensure_ascii=False, default=_json_default)
+
+
+def loads_json(string: str) -> Any:
+    return json.loads(string, object_hook=_json_object_hook)
+
+
+class CaptionStore(Mapping):
+    """SQLite backed storage of `VideoDatum`s, keyed by the video id.
+
+    Each datum is stored as one row, so that a run reads only the records it needs and
+    rewrites only the changed ones (unlike the whole pickle file).
+    The values are stored in json instead of pickle, which is not safe to load.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self._connection = sqlite3.connect(str(path))
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS videos ('
+            'video_id TEXT PRIMARY KEY, '
+            'published TEXT NOT NULL, '
+            'augmenter_version INTEGER, '
+            'video_info TEXT NOT NULL, '
+            'caption_info TEXT NOT NULL, '
+            'rest TEXT NOT NULL)')
+        self._connection.commit()
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def __getitem__(self, video_id: str) -> VideoDatum:
+        row = self._connection.execute(
+            'SELECT video_info, caption_info, rest FROM videos WHERE video_id = ?',
+            (video_id,)).fetchone()
+        if row is None:
+            raise KeyError(video_id)
+        video_info, caption_info, rest = row
+        video_datum = dict(video_info=loads_json(video_info),
+                           caption_info=loads_json(caption_info))
+        video_datum.update(loads_json(rest))
+        return video_datum
+
+    def __contains__(self, video_id: object) -> bool:
+        return self._connection.execute('SELECT 1 FROM videos WHERE video_id = ?',
+                                        (video_id,)).fetchone() is not None
+
+    def __iter__(self) -> Iterator[str]:
+        # newest first, in the same order as the uploads playlist
+        rows = self._connection.execute(
+            'SELECT video_id FROM videos ORDER BY published DESC, video_id').fetchall()
+        return iter([row[0] for row in rows])
+
+    def __len__(self) -> int:
+        return self._connection.execute('SELECT COUNT(*) FROM videos').fetchone()[0]
+
+    def summaries(self) -> Dict[str, VideoDatum]:
+        """Returns the data having only 'video_info' and 'caption_info', without the captions."""
+        rows = self._connection.execute(
+            'SELECT video_id, video_info, caption_info FROM videos '
+            'ORDER BY published DESC, video_id')
+        return {video_id: dict(video_info=loads_json(video_info),
+                               caption_info=loads_json(caption_info))
+                for video_id, video_info, caption_info in rows}
+
+    def video_ids_to_augment(self, augmenter_version: int) -> List[str]:
+        """Returns the ids of the videos whose captions are not augmented with the version."""
+        rows = self._connection.execute(
+            'SELECT video_id FROM videos '
+            'WHERE augmenter_version IS NULL OR augmenter_version != ? '
+            'ORDER BY published DESC, video_id', (augmenter_version,))
+        return [row[0] for row in rows]
+
+    def upsert(self, data: Iterable[VideoDatum]) -> None:
+        rows = []
+        for video_datum in data:
+            video_info = video_datum['video_info']
+            caption_info = video_datum['caption_info']
+            augmentation_info: Optional[Dict[str, Any]] = video_datum.get(  # type: ignore
+                'augmentation_info')
+            augmenter_version = None
+            if (augmentation_info is not None
+                    and (augmentation_info['last_updated']
+                         == caption_info['last_updated'])):  # type: ignore
+                augmenter_version = augmentation_info['version']
+            rest = {key: value for key, value in video_datum.items()
+                    if key not in ('video_info', 'caption_info')}
+            rows.append((video_info['video_id'],  # type: ignore
+                         video_info['published'].isoformat(),  # type: ignore
+                         augmenter_version,
+                         dumps_json(video_info), dumps_json(caption_info), dumps_json(rest)))
+        with self._connection:
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO videos VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+    def delete(self, video_ids: Iterable[str]) -> None:
+        with self._connection:
+            self._connection.executemany('DELETE FROM videos WHERE video_id = ?',
+                                         [(video_id,) for video_id in video_ids])
+
+    def to_data(self) -> Data:
+        return [self[video_id] for video_id in self]
+
+    def migrate_from_pickle(self, pickle_file: BinaryIO) -> int:
+        """Imports the data in the (trusted) pickle file made by the former `main.py`."""
+        # note: this is BAD because pickle.load is not secure for outside binary file!
+        old_data: Data = expand_data(pickle.load(pickle_file))
+        self.upsert(old_data)
+        return len(old_data)
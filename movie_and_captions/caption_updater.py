@@ -1,13 +1,28 @@
 import datetime
+import math
 from logging import getLogger, Logger
-from typing import Sequence, Optional, Union, Optional
+from typing import (Sequence, Optional, Union, Optional, Mapping, List, Iterable, Iterator,
+                    Tuple, Deque, NamedTuple, Dict)
 from pathlib import Path
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, Future
 from tqdm import tqdm
 import pickle
 
 from movie_and_captions.youtube_api import YoutubeAPI, DirtyYoutubeAPI
-from movie_and_captions.models import CaptionInfo
-from movie_and_captions.data import Data, VideoDatum
+from movie_and_captions.youtube_api.quota import QuotaExceeded, quota_cost
+from movie_and_captions.models import CaptionInfo, VideoInfo
+from movie_and_captions.data import Data, VideoDatum, ChangeSet
+from movie_and_captions.checkpoint import CheckpointJournal
+
+
+class UpdatePlan(NamedTuple):
+    # all the video ids of the channel, in playlist order
+    video_ids: List[str]
+    # the videos whose captions are to be downloaded, in playlist order
+    downloads: List[Tuple[VideoInfo, CaptionInfo]]
+    removed: List[str]
 
 
 class CaptionUpdater:
@@ -15,11 +30,32 @@ class CaptionUpdater:
             self,
             youtube_api: YoutubeAPI,
             dirty_youtube_api: DirtyYoutubeAPI = None,
-            logger: Logger = getLogger(__name__)
+            logger: Logger = getLogger(__name__),
+            max_workers: int = 1,
+            journal: Optional[CheckpointJournal] = None,
+            executor: Optional[ThreadPoolExecutor] = None
     ) -> None:
         self._youtube_api = youtube_api
+        # the videos in the journal are taken from it, instead of checking and downloading again
+        self._journal = journal
         self._logger = logger
         self._dirty_youtube_api = dirty_youtube_api
+        assert max_workers >= 1
+        self._max_workers = max_workers
+        # the executor shared with the other updaters (of other channels), if given,
+        # so that `max_workers` limits the requests in total
+        self._executor = executor
+        self._incremental_stop_after_known = 10
+        # share of the checks whose retries are kept in the quota budget
+        self._quota_retry_headroom = 0.1
+
+    @contextmanager
+    def _get_executor(self) -> Iterator[ThreadPoolExecutor]:
+        if self._executor is not None:
+            yield self._executor
+        else:
+            with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+                yield executor
 
     def _check_caption(
             self,
@@ -56,48 +92,316 @@ class CaptionUpdater:
             assert len(valid_caption_infos) == 1
             return valid_caption_infos[0]
 
+    def _find_updated_caption(
+            self,
+            video_id: str,
+            old_datum: Optional[VideoDatum]
+    ) -> Tuple[bool, Optional[CaptionInfo]]:
+        """Returns if the video is checked, and its updated caption (None if not updated).
+
+        A video over the quota budget is not checked, and deferred to the next runs.
+        """
+        quota_budget = self._youtube_api.quota_budget
+        if quota_budget is not None:
+            # give back the units reserved for this check, just before they are charged
+            quota_budget.release(quota_cost('youtube.captions.list'))
+        if old_datum is not None:
+            old_caption_info = CaptionInfo(**old_datum['caption_info'])  # type: ignore
+            last_updated = old_caption_info.last_updated
+        else:
+            last_updated = datetime.datetime.min.replace(tzinfo=datetime.timezone.utc)
+        try:
+            with self._youtube_api.metrics.stage('check_caption'):
+                caption_infos = self._youtube_api.get_caption_infos_from_video_id(video_id)
+        except QuotaExceeded as error:
+            # the retries of the other checks may have used up the budget
+            self._logger.debug('{} is deferred: {}'.format(video_id, error))
+            return False, None
+        self._youtube_api.metrics.increment('videos_total', stage='checked')
+        if quota_budget is not None:
+            quota_budget.mark_checked(video_id)
+        caption_info = self._get_valid_caption(caption_infos, last_updated)
+        if self._journal is not None:
+            self._journal.record_check(video_id,
+                                       None if caption_info is None else caption_info._asdict())
+        return True, caption_info
+
+    def _schedule_caption_checks(
+            self,
+            video_ids: Sequence[str],
+            old_summaries: Mapping[str, VideoDatum]
+    ) -> Tuple[List[str], int]:
+        """Orders the videos to check by priority, and drops the ones over the quota budget.
+
+        The new videos come first (newest first), then the known videos never checked
+        (recently published or updated first), and then the others (least recently checked
+        first). The dropped videos are deferred to the next runs as if they are unchanged.
+        The units of the checks and of resolving the video infos are reserved in the budget,
+        and the latter is returned; each check releases its own units.
+        """
+        quota_budget = self._youtube_api.quota_budget
+        if quota_budget is None:
+            return list(video_ids), 0
+
+        def recency(video_id: str) -> datetime.datetime:
+            old_summary = old_summaries[video_id]
+            return max(old_summary['video_info']['published'],  # type: ignore
+                       old_summary['caption_info']['last_updated'])  # type: ignore
+
+        new_video_ids = [video_id for video_id in video_ids if video_id not in old_summaries]
+        known_video_ids = [video_id for video_id in video_ids if video_id in old_summaries]
+        never_checked_video_ids = sorted(
+            [video_id for video_id in known_video_ids
+             if quota_budget.last_checked(video_id) is None],
+            key=recency, reverse=True)
+        checked_video_ids = sorted(
+            [video_id for video_id in known_video_ids
+             if quota_budget.last_checked(video_id) is not None],
+            key=quota_budget.last_checked)  # type: ignore
+        scheduled_video_ids = new_video_ids + never_checked_video_ids + checked_video_ids
+
+        # keep the quota to retry some of the checks, and to resolve the video infos of
+        # the updated videos
+        check_cost = quota_cost('youtube.captions.list')
+        video_info_cost = quota_cost('youtube.videos.list')
+
+        def video_info_units(check_num: int) -> int:
+            return math.ceil(check_num / 50) * video_info_cost
+
+        def cost(check_num: int) -> int:
+            retry_num = math.ceil(check_num * self._quota_retry_headroom)
+            return (check_num + retry_num) * check_cost + video_info_units(check_num)
+
+        # reserve at once, since the other channels may be scheduling their checks now.
+        # the units for the retries are left unreserved, shared with the other channels
+        remaining = quota_budget.remaining
+        reserved = quota_budget.reserve(cost(len(scheduled_video_ids)))
+        affordable_num = min(len(scheduled_video_ids), reserved // check_cost)
+        while affordable_num > 0 and cost(affordable_num) > reserved:
+            affordable_num -= 1
+        quota_budget.release(reserved - affordable_num * check_cost
+                             - video_info_units(affordable_num))
+        self._logger.warning('checking captions of {} videos needs about {} quota units, '
+                             '{} of {} units are left today'
+                             .format(len(scheduled_video_ids),
+                                     len(scheduled_video_ids) * check_cost, remaining,
+                                     quota_budget.daily_limit))
+        if affordable_num < len(scheduled_video_ids):
+            self._youtube_api.metrics.increment('videos_total',
+                                                len(scheduled_video_ids) - affordable_num,
+                                                stage='deferred')
+            self._logger.warning('{} videos are deferred to the next runs for the quota budget'
+                                 .format(len(scheduled_video_ids) - affordable_num))
+        return scheduled_video_ids[:affordable_num], video_info_units(affordable_num)
+
+    def _download_video_datum(
+            self,
+            video_info: VideoInfo,
+            caption_info: CaptionInfo
+    ) -> VideoDatum:
+        self._logger.debug('valid caption is found. downloading.')
+        assert self._dirty_youtube_api is not None
+        captions = self._dirty_youtube_api.download_caption(video_info, caption_info)
+
+        # convert into dicts
+        caption_info_asdict = caption_info._asdict()
+        video_info_asdict = video_info._asdict()
+        captions_asdicts = [caption._asdict() for caption in captions]
+
+        return dict(
+            captions=captions_asdicts,
+            caption_info=caption_info_asdict,
+            video_info=video_info_asdict
+        )
+
+    def _download_or_resume_video_datum(
+            self,
+            video_info: VideoInfo,
+            caption_info: CaptionInfo
+    ) -> VideoDatum:
+        if self._journal is None:
+            return self._download_video_datum(video_info, caption_info)
+        journaled_datum = self._journal.get(video_info.video_id)
+        if journaled_datum is not None:
+            self._youtube_api.metrics.increment('videos_total', stage='resumed')
+            return journaled_datum
+        video_datum = self._download_video_datum(video_info, caption_info)
+        self._journal.record(video_datum)
+        return video_datum
+
+    def _scan_video_ids(
+            self,
+            playlist_id: str,
+            old_summaries: Mapping[str, VideoDatum],
+            incremental: bool
+    ) -> List[str]:
+        if not incremental or len(old_summaries) == 0:
+            return self._youtube_api.get_video_ids_from_playlist_id(playlist_id)
+
+        known_until = max(
+            VideoInfo(**old_summary['video_info']).published  # type: ignore
+            for old_summary in old_summaries.values())
+        new_video_ids = self._youtube_api.get_video_ids_from_playlist_id(
+            playlist_id, known_video_ids=old_summaries.keys(), known_until=known_until,
+            stop_after_known=self._incremental_stop_after_known)
+        # the videos not reached in the scan are assumed to be still alive;
+        # deleted ones are removed only when a full scan is done
+        new_video_id_set = set(new_video_ids)
+        return new_video_ids + [video_id for video_id in old_summaries
+                                if video_id not in new_video_id_set]
+
+    def plan_update(
+            self,
+            target_channel_id: str,
+            old_summaries: Mapping[str, VideoDatum],
+            incremental: bool = False,
+            recheck_since: Optional[datetime.datetime] = None
+    ) -> UpdatePlan:
+        """Finds the updated captions of the channel, without downloading them.
+
+        `old_summaries` maps each known video id to its old datum, of which only
+        'video_info' and 'caption_info' are used.
+        With `recheck_since`, the captions of the known videos published before it are
+        assumed to be unchanged, and not checked.
+        """
+        metrics = self._youtube_api.metrics
+        with metrics.stage('scan_playlist'):
+            playlist_id = self._youtube_api.get_playlist_id_from_channel_id(target_channel_id)
+            video_ids = self._scan_video_ids(playlist_id, old_summaries, incremental)
+
+        # only 'video_info' and 'caption_info' of the journaled videos are read here
+        journaled_data: Dict[str, VideoDatum] = {}
+        # the videos checked before the interruption are not checked again
+        journaled_checks: Dict[str, Optional[CaptionInfo]] = {}
+        if self._journal is not None:
+            journaled_data = self._journal.summaries()
+            journaled_checks = {
+                video_id: None if caption_info is None else CaptionInfo(**caption_info)
+                for video_id, caption_info in self._journal.checks().items()}
+        candidate_video_ids = [video_id for video_id in video_ids
+                               if video_id not in journaled_data
+                               and video_id not in journaled_checks]
+        if recheck_since is not None:
+            candidate_video_ids = [
+                video_id for video_id in candidate_video_ids
+                if video_id not in old_summaries
+                or (old_summaries[video_id]['video_info']['published']  # type: ignore
+                    >= recheck_since)]
+        video_ids_to_check, video_info_units = self._schedule_caption_checks(
+            candidate_video_ids, old_summaries)
+
+        # find if each video exists in the old data
+        old_summaries_of_videos = [old_summaries.get(video_id) for video_id in video_ids_to_check]
+
+        try:
+            # videos are processed in parallel, but `map` keeps the results in the scheduled
+            # order
+            with self._get_executor() as executor:
+                # check which videos have new captions
+                check_results = list(tqdm(
+                    executor.map(self._find_updated_caption, video_ids_to_check,
+                                 old_summaries_of_videos),
+                    total=len(video_ids_to_check)))
+        finally:
+            # the units reserved for resolving the video infos are charged from here
+            if self._youtube_api.quota_budget is not None:
+                self._youtube_api.quota_budget.release(video_info_units)
+        deferred_num = sum(1 for checked, _ in check_results if not checked)
+        if deferred_num > 0:
+            metrics.increment('videos_total', deferred_num, stage='deferred')
+            self._logger.warning('{} videos are deferred to the next runs, since the quota is '
+                                 'used up while checking them'.format(deferred_num))
+        video_id_to_caption_info = {video_id: caption_info for video_id, (_, caption_info)
+                                    in zip(video_ids_to_check, check_results)}
+        video_id_to_caption_info.update(journaled_checks)
+        for video_id, journaled_datum in journaled_data.items():
+            video_id_to_caption_info[video_id] = CaptionInfo(
+                **journaled_datum['caption_info'])  # type: ignore
+        updated_video_ids = [video_id for video_id in video_ids
+                             if video_id_to_caption_info.get(video_id) is not None]
+
+        # resolve video infos in bulk
+        with metrics.stage('video_infos'):
+            try:
+                video_infos = self._youtube_api.get_video_infos_from_video_ids(
+                    [video_id for video_id in updated_video_ids
+                     if video_id not in journaled_data])
+            except QuotaExceeded as error:
+                # the updated videos are found again in the next runs
+                self._logger.warning('the updated videos are deferred: {}'.format(error))
+                video_infos = {}
+        for video_id, journaled_datum in journaled_data.items():
+            video_infos[video_id] = VideoInfo(**journaled_datum['video_info'])  # type: ignore
+        downloads = [(video_infos[video_id], video_id_to_caption_info[video_id])
+                     for video_id in updated_video_ids if video_id in video_infos]
+
+        video_id_set = set(video_ids)
+        removed_video_ids = [video_id for video_id in old_summaries
+                             if video_id not in video_id_set]
+        return UpdatePlan(video_ids=video_ids, downloads=downloads,  # type: ignore
+                          removed=removed_video_ids)
+
+    def iterate_downloads(
+            self,
+            downloads: Iterable[Tuple[VideoInfo, CaptionInfo]],
+            max_in_flight: Optional[int] = None
+    ) -> Iterator[VideoDatum]:
+        """Downloads the captions in parallel, and yields the data in the given order.
+
+        At most `max_in_flight` downloads are running or waiting to be consumed,
+        so that the memory is bounded even if the consumer is slower than the network.
+        """
+        if max_in_flight is None:
+            max_in_flight = self._max_workers * 2
+        assert max_in_flight >= 1
+        with self._get_executor() as executor:
+            futures: Deque[Future] = deque()
+            try:
+                for video_info, caption_info in downloads:
+                    if len(futures) >= max_in_flight:
+                        yield futures.popleft().result()
+                    futures.append(executor.submit(self._download_or_resume_video_datum,
+                                                   video_info, caption_info))
+                while len(futures) > 0:
+                    yield futures.popleft().result()
+            finally:
+                # the consumer stopped early; do not start the remaining downloads
+                for future in futures:
+                    future.cancel()
+
+    def update(
+            self,
+            target_channel_id: str,
+            old_summaries: Mapping[str, VideoDatum],
+            incremental: bool = False,
+            recheck_since: Optional[datetime.datetime] = None
+    ) -> ChangeSet:
+        """Finds and downloads the updated captions of the channel.
+
+        `old_summaries` maps each known video id to its old datum, of which only
+        'video_info' and 'caption_info' are used.
+        """
+        plan = self.plan_update(target_channel_id, old_summaries, incremental, recheck_since)
+        updated_data = list(tqdm(self.iterate_downloads(plan.downloads),
+                                 total=len(plan.downloads)))
+        return ChangeSet(video_ids=plan.video_ids, updated=updated_data, removed=plan.removed)
+
     def do(
             self,
             target_channel_id: str,
-            old_data: Data
+            old_data: Data,
+            incremental: bool = False
     ) -> Data:
-        playlist_id = self._youtube_api.get_playlist_id_from_channel_id(target_channel_id)
-        video_ids = self._youtube_api.get_video_ids_from_playlist_id(playlist_id)
-
         video_id_to_data = {old_datum['video_info']['video_id']: old_datum  # type: ignore
                             for old_datum in old_data}
+        changes = self.update(target_channel_id, video_id_to_data, incremental)
+        video_id_to_new_datum = {new_datum['video_info']['video_id']: new_datum  # type: ignore
+                                 for new_datum in changes.updated}
 
         new_data: Data = []
-        for video_id in tqdm(video_ids):
-            # find if the specified video exists in the old_data
-            old_datum: Optional[VideoDatum]
-            if video_id in video_id_to_data:
-                old_datum = video_id_to_data[video_id]
-                old_caption_info = CaptionInfo(**old_datum['caption_info'])  # type: ignore
-                last_updated = old_caption_info.last_updated
-            else:
-                old_datum = None
-                last_updated = datetime.datetime.min.replace(tzinfo=datetime.timezone.utc)
-            caption_infos = self._youtube_api.get_caption_infos_from_video_id(video_id)
-            caption_info = self._get_valid_caption(caption_infos, last_updated)
-            if caption_info is not None:
-                self._logger.debug('valid caption is found. downloading.')
-                video_info = self._youtube_api.get_video_info_from_video_id(video_id)
-                assert self._dirty_youtube_api is not None
-                captions = self._dirty_youtube_api.download_caption(video_info, caption_info)
-
-                # convert into dicts
-                caption_info_asdict = caption_info._asdict()
-                video_info_asdict = video_info._asdict()
-                captions_asdicts = [caption._asdict() for caption in captions]
-
-                # add new captions
-                new_data.append(dict(
-                    captions=captions_asdicts,
-                    caption_info=caption_info_asdict,
-                    video_info=video_info_asdict
-                ))
-            else:
-                if old_datum is not None:
-                    new_data.append(old_datum)
+        for video_id in changes.video_ids:
+            if video_id in video_id_to_new_datum:
+                new_data.append(video_id_to_new_datum[video_id])
+            elif video_id in video_id_to_data:
+                new_data.append(video_id_to_data[video_id])
         return new_data
@@ -1,28 +1,64 @@
-from typing import Union, Optional, List
+from typing import (Union, Optional, List, Tuple, Iterable, Iterator, Deque, Callable,
+                    TYPE_CHECKING)
 from pathlib import Path
 from logging import getLogger, Logger
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, Future
 import pickle
 from tqdm import tqdm
-import MeCab
-import jaconv
+import itertools
 import re
+import threading
 
 from movie_and_captions.models import Caption, AugmentedCaption
-from movie_and_captions.data import Data
+from movie_and_captions.data import Data, VideoDatum
+from movie_and_captions.metrics import Metrics, MetricsSnapshot
+from movie_and_captions.augmentation_cache import (AugmentationCache, AugmentationCacheStats,
+                                                   AugmentationResult)
+
+# MeCab loads its dictionary when a tagger is built, so it is imported when used
+if TYPE_CHECKING:
+    import MeCab
 
 
 class CaptionWithMecab:
+    # bump this when the rules in `augment_caption` are changed,
+    # so that the captions augmented with the older rules are recomputed
+    AUGMENTER_VERSION = 1
+
     def __init__(
             self,
-            logger: Logger = getLogger(__name__)
+            logger: Logger = getLogger(__name__),
+            max_workers: int = 1,
+            cache_size: int = 0,
+            cache_path: Optional[Path] = None,
+            metrics: Optional[Metrics] = None
     ) -> None:
         self._logger = logger
-        self._mecab_yomi = MeCab.Tagger('-Oyomi')
-        self._mecab_tagger = MeCab.Tagger()
-        # bad know-how to prevent UnicodeDecodeError
-        # see: https://qiita.com/kasajei/items/0805b433f363f1dba785
-        self._mecab_yomi.parse('')
-        self._mecab_tagger.parse('')
+        if metrics is None:
+            metrics = Metrics()
+        self._metrics = metrics
+        assert max_workers >= 1
+        self._max_workers = max_workers
+        # keep the arguments to build the same caches in the worker processes
+        self._cache_size = cache_size
+        self._cache_path = cache_path
+        self._augmentation_cache: Optional[AugmentationCache] = None
+        # the sqlite cache is used even without the in-memory one
+        if cache_size > 0 or cache_path is not None:
+            self._augmentation_cache = AugmentationCache(self.AUGMENTER_VERSION, cache_size,
+                                                         cache_path)
+        self._worker_cache_stats = AugmentationCacheStats(0, 0, 0)
+        # the worker processes are started once and reused by all the calls (and channels)
+        self._process_pool: Optional[ProcessPoolExecutor] = None
+        # MeCab taggers and the cache are not thread-safe; the callers in other threads
+        # (for other channels) take turns
+        self._lock = threading.RLock()
+        # the taggers are built on the first use, since loading the dictionary takes a while
+        # and many runs have nothing to augment
+        self._mecab_yomi: Optional['MeCab.Tagger'] = None
+        self._mecab_tagger: Optional['MeCab.Tagger'] = None
+        self._kata2hira: Optional[Callable[[str], str]] = None
         # match with the strings that starts and ends with one of the remove / save parens
         parens_map = dict(removing=[('\(', '\)'), ('（', '）'), ('<', '>')],
                           saving=[('「', '」'), ('\'', '\''), ('"', '"')])
@@ -50,18 +86,36 @@ class CaptionWithMecab:
             62, 63, 64, 65, 66, 67,  # 非自立語幹
         ])
 
-    def augment_caption(self, caption: Caption) -> Optional[AugmentedCaption]:
-        # remove parentheses
-        text = caption.content
-        text = text.replace('\n', '')
+    def _build_taggers(self) -> None:
+        import jaconv
+        import MeCab
+        mecab_yomi = MeCab.Tagger('-Oyomi')
+        # outputs `yomi \n surface \t pos id \n` for each morph, where the yomi is formatted in
+        # the same way as `-Oyomi` (`%pS%f[7]` for known words and `%M` for unknown words),
+        # so that both of the yomi and the short title are made from one tokenization.
+        # note: backslashes are doubled since MeCab unescapes its arguments before the formats
+        mecab_tagger = MeCab.Tagger(r'-F%pS%f[7]\\n%m\\t%h\\n -U%M\\n%m\\t%h\\n -E\\n')
+        # bad know-how to prevent UnicodeDecodeError
+        # see: https://qiita.com/kasajei/items/0805b433f363f1dba785
+        mecab_yomi.parse('')
+        mecab_tagger.parse('')
+        self._mecab_yomi = mecab_yomi
+        self._mecab_tagger = mecab_tagger
+        self._kata2hira = jaconv.kata2hira
+
+    def _remove_parens(self, text: str) -> str:
+        # remove the innermost parenthesis pairs repeatedly.
+        # each `sub` removes all of the innermost pairs at once, so the number of the passes is
+        # the depth of the nesting, not the number of the pairs
         while True:
-            # search minimal parenthesis pair
-            match = self._removing_parens_regex.search(text)
-            if match is None:
-                break
-            text = text[:match.start()] + text[match.end():]
-            if len(text) == 0:
-                return None
+            removed_text = self._removing_parens_regex.sub('', text)
+            if len(removed_text) == len(text):
+                return text
+            text = removed_text
+
+    def _augment_text(self, text: str) -> AugmentationResult:
+        # remove parentheses
+        text = self._remove_parens(text)
         # save parenthesis
         match = self._saving_parens_regex.search(text)
         if match is not None:
@@ -73,19 +127,29 @@ class CaptionWithMecab:
                 text = text_candidate
         if len(text) == 0:
             return None
-        # get yomi
-        yomi_katakana = self._mecab_yomi.parse(text).strip()
-        yomi = jaconv.kata2hira(yomi_katakana)
-        # make short title
+        if self._mecab_tagger is None:
+            self._build_taggers()
+        mecab_yomi, mecab_tagger, kata2hira = (self._mecab_yomi, self._mecab_tagger,
+                                               self._kata2hira)
+        assert mecab_yomi is not None and mecab_tagger is not None and kata2hira is not None
         if len(text) <= self._short_title_length_range['min']:
+            # get yomi (short title is not needed)
+            yomi_katakana = mecab_yomi.parse(text).strip()
             short_title = text
         else:
-            mecab_node = self._mecab_tagger.parseToNode(text).next
+            # tokenize only once, and get both of the yomi and the short title from the output.
+            # the text has no line breaks, so the lines are yomi and `surface \t pos id` in turn
+            # (the last two lines are the empty EOS and the end of the output)
+            parsed_lines = mecab_tagger.parse(text).split('\n')
+            # get yomi
+            yomi_katakana = ''.join(parsed_lines[0:-2:2]).strip()
+            # make short title
             text_ends = 0
             previous_continuous_flag = False
-            while mecab_node is not None and mecab_node.next is not None:
+            for morph_info in itertools.islice(parsed_lines, 1, len(parsed_lines) - 2, 2):
                 check_length = True
-                feature_posid = mecab_node.posid
+                surface, posid = morph_info.split('\t')
+                feature_posid = int(posid)
                 # if the pos tag is not self-standing one (自立語), continue
                 if feature_posid in self._not_selfstanding_poses:
                     check_length = False
@@ -96,35 +160,227 @@ class CaptionWithMecab:
                 if feature_posid in self._not_ending_poses:
                     previous_continuous_flag = True
                 # check length
-                text_ends_will_be = text_ends + len(mecab_node.surface)
+                text_ends_will_be = text_ends + len(surface)
                 if check_length and text_ends_will_be >= self._short_title_length_range['min']:
                     break
                 if text_ends_will_be >= self._short_title_length_range['max']:
                     break
                 text_ends = text_ends_will_be
-                mecab_node = mecab_node.next
             short_title = text[:text_ends]
+        yomi = kata2hira(yomi_katakana)
+        return short_title, yomi
+
+    def augment_caption(self, caption: Caption) -> Optional[AugmentedCaption]:
+        text = caption.content
+        text = text.replace('\n', '')
+        # the same texts appear many times (greetings, music cues, ...), so memoize the results
+        if self._augmentation_cache is None:
+            result = self._augment_text(text)
+        else:
+            key = self._augmentation_cache.key(text)
+            cached_result = self._augmentation_cache.get(key)
+            if cached_result is AugmentationCache.MISSING:
+                result = self._augment_text(text)
+                self._augmentation_cache.put(key, result)
+            else:
+                result = cached_result  # type: ignore
+        if result is None:
+            return None
+        short_title, yomi = result
         augmented_caption = AugmentedCaption(short_title=short_title, yomi=yomi,
                                              **caption._asdict())
         if len(short_title) < len(caption.content):
-            self._logger.debug('convert {} to {}'.format(caption.content, short_title))
+            self._logger.debug('convert %s to %s', caption.content, short_title)
         return augmented_caption
 
-    def do(
-            self,
-            old_data: Data
-    ) -> Data:
-        new_data = []
-        for i, video_datum in enumerate(tqdm(old_data)):
-            caption_asdicts = video_datum['captions']
-            captions: List[Caption] = [Caption(**caption_asdict)
-                                       for caption_asdict in caption_asdicts]
-            augmented_caption_asdicts = []
+    def _is_augmented(self, video_datum: VideoDatum) -> bool:
+        # the augmented captions are reusable if they are made by the same version of rules
+        # from the same captions
+        if 'augmented_captions' not in video_datum:
+            return False
+        augmentation_info = video_datum.get('augmentation_info')
+        if augmentation_info is None:
+            return False
+        return (augmentation_info['version'] == self.AUGMENTER_VERSION  # type: ignore
+                and augmentation_info['last_updated']  # type: ignore
+                == video_datum['caption_info']['last_updated'])  # type: ignore
+
+    def _augment_video_datum(self, video_datum: VideoDatum) -> VideoDatum:
+        caption_asdicts = video_datum['captions']
+        captions: List[Caption] = [Caption(**caption_asdict)
+                                   for caption_asdict in caption_asdicts]
+        augmented_caption_asdicts = []
+        with self._lock, self._metrics.stage('mecab'):
+            cache_stats_before = self._own_cache_stats()
             for caption in captions:
                 augmented_caption = self.augment_caption(caption)
                 if augmented_caption is not None:
                     augmented_caption_asdicts.append(augmented_caption._asdict())
-            new_data_dict = dict(**video_datum)
-            new_data_dict['augmented_captions'] = augmented_caption_asdicts
-            new_data.append(new_data_dict)
+            self._count_augmentation(len(captions), cache_stats_before)
+        new_data_dict = dict(**video_datum)
+        new_data_dict['augmented_captions'] = augmented_caption_asdicts
+        new_data_dict['augmentation_info'] = dict(
+            version=self.AUGMENTER_VERSION,
+            last_updated=video_datum['caption_info']['last_updated'])  # type: ignore
+        return new_data_dict
+
+    def _count_augmentation(
+            self,
+            caption_num: int,
+            cache_stats_before: AugmentationCacheStats
+    ) -> None:
+        self._metrics.increment('videos_total', stage='augmented')
+        self._metrics.increment('cues_total', caption_num, stage='augmented')
+        if self._augmentation_cache is not None:
+            hits, disk_hits, misses = [after - before for after, before
+                                       in zip(self._own_cache_stats(), cache_stats_before)]
+            self._metrics.increment('cache_hits_total', hits, cache='augmentation')
+            self._metrics.increment('cache_hits_total', disk_hits, cache='augmentation_disk')
+            self._metrics.increment('cache_misses_total', misses, cache='augmentation')
+
+    def _get_process_pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._process_pool is None:
+                self._process_pool = ProcessPoolExecutor(
+                    max_workers=self._max_workers, initializer=_initialize_worker,
+                    initargs=(self._cache_size, self._cache_path))
+            return self._process_pool
+
+    def close(self) -> None:
+        """Stops the worker processes."""
+        with self._lock:
+            if self._process_pool is not None:
+                self._process_pool.shutdown()
+                self._process_pool = None
+
+    def _augment_in_processes(self, target_data: Data) -> Data:
+        # a few chunks per worker to balance the load between workers
+        chunk_size = max(1, len(target_data) // (self._max_workers * 4))
+        chunks = [target_data[i:i + chunk_size] for i in range(0, len(target_data), chunk_size)]
+        augmented_data: Data = []
+        executor = self._get_process_pool()
+        with tqdm(total=len(target_data)) as progress_bar:
+            # `map` returns the chunks in the input order
+            for augmented_chunk, cache_stats, metrics in executor.map(
+                    _augment_video_data_in_worker, chunks):
+                augmented_data.extend(augmented_chunk)
+                self._add_worker_cache_stats(cache_stats)
+                self._metrics.merge(metrics)
+                progress_bar.update(len(augmented_chunk))
+        return augmented_data
+
+    def _add_worker_cache_stats(self, cache_stats: AugmentationCacheStats) -> None:
+        with self._lock:
+            self._worker_cache_stats = AugmentationCacheStats(
+                *[total + delta for total, delta in zip(self._worker_cache_stats, cache_stats)])
+
+    def iterate_augmented(
+            self,
+            data: Iterable[VideoDatum],
+            max_in_flight: Optional[int] = None
+    ) -> Iterator[VideoDatum]:
+        """Augments the data as they come, and yields them in the given order.
+
+        `data` can be a generator still downloading the captions, so that the augmentation
+        overlaps with the network. With `max_workers` > 1, at most `max_in_flight` data are
+        augmented in the worker processes at once.
+        """
+        if self._max_workers == 1:
+            for video_datum in data:
+                if self._is_augmented(video_datum):
+                    yield video_datum
+                else:
+                    yield self._augment_video_datum(video_datum)
+            if self._augmentation_cache is not None:
+                with self._lock:
+                    self._augmentation_cache.save()
+            return
+
+        if max_in_flight is None:
+            max_in_flight = self._max_workers * 2
+        assert max_in_flight >= 1
+        executor = self._get_process_pool()
+        # the data already augmented are kept in the queue to keep the order
+        futures: Deque[Union[VideoDatum, Future]] = deque()
+        try:
+            for video_datum in data:
+                if len(futures) >= max_in_flight:
+                    yield self._take_augmented(futures.popleft())
+                if self._is_augmented(video_datum):
+                    futures.append(video_datum)
+                else:
+                    futures.append(executor.submit(_augment_video_data_in_worker,
+                                                   [video_datum]))
+            while len(futures) > 0:
+                yield self._take_augmented(futures.popleft())
+        finally:
+            for future in futures:
+                if isinstance(future, Future):
+                    future.cancel()
+
+    def _take_augmented(self, future: Union[VideoDatum, Future]) -> VideoDatum:
+        if not isinstance(future, Future):
+            return future
+        augmented_data, cache_stats, metrics = future.result()
+        self._add_worker_cache_stats(cache_stats)
+        self._metrics.merge(metrics)
+        return augmented_data[0]
+
+    def _own_cache_stats(self) -> AugmentationCacheStats:
+        if self._augmentation_cache is None:
+            return AugmentationCacheStats(0, 0, 0)
+        return self._augmentation_cache.stats
+
+    @property
+    def cache_stats(self) -> AugmentationCacheStats:
+        """Statistics of the augmentation caches, including the ones in the worker processes."""
+        return AugmentationCacheStats(*[own + worker for own, worker
+                                        in zip(self._own_cache_stats(), self._worker_cache_stats)])
+
+    def do(
+            self,
+            old_data: Data
+    ) -> Data:
+        target_indices = [i for i, video_datum in enumerate(old_data)
+                          if not self._is_augmented(video_datum)]
+        target_data = [old_data[i] for i in target_indices]
+        if self._max_workers > 1 and len(target_data) > 1:
+            augmented_data = self._augment_in_processes(target_data)
+        else:
+            augmented_data = [self._augment_video_datum(video_datum)
+                              for video_datum in tqdm(target_data)]
+
+        if self._augmentation_cache is not None:
+            with self._lock:
+                self._augmentation_cache.save()
+
+        new_data = list(old_data)
+        for i, augmented_datum in zip(target_indices, augmented_data):
+            new_data[i] = augmented_datum
         return new_data
+
+
+# each worker process builds its own taggers once, and reuses them for all the chunks
+_worker_caption_with_mecab: Optional[CaptionWithMecab] = None
+
+
+def _initialize_worker(cache_size: int, cache_path: Optional[Path]) -> None:
+    global _worker_caption_with_mecab
+    _worker_caption_with_mecab = CaptionWithMecab(cache_size=cache_size, cache_path=cache_path)
+
+
+def _augment_video_data_in_worker(
+        video_data: Data
+) -> Tuple[Data, AugmentationCacheStats, MetricsSnapshot]:
+    assert _worker_caption_with_mecab is not None
+    stats_before = _worker_caption_with_mecab.cache_stats
+    augmented_data = [_worker_caption_with_mecab._augment_video_datum(video_datum)
+                      for video_datum in video_data]
+    if _worker_caption_with_mecab._augmentation_cache is not None:
+        _worker_caption_with_mecab._augmentation_cache.save()
+    # return the statistics of this chunk only
+    stats_delta = AugmentationCacheStats(
+        *[after - before
+          for after, before in zip(_worker_caption_with_mecab.cache_stats, stats_before)])
+    # the metrics are also of this chunk only, since `take` resets them
+    return augmented_data, stats_delta, _worker_caption_with_mecab._metrics.take()
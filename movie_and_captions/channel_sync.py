@@ -0,0 +1,175 @@
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger, Logger
+from pathlib import Path
+from typing import Optional, Sequence, List, Dict, TextIO, NamedTuple
+import datetime
+import pickle
+
+from movie_and_captions.youtube_api import YoutubeAPI, DirtyYoutubeAPI, QuotaExceeded
+from movie_and_captions.caption_updater import CaptionUpdater
+from movie_and_captions.caption_with_mecab import CaptionWithMecab
+from movie_and_captions.caption_store import CaptionStore
+from movie_and_captions.checkpoint import CheckpointJournal
+from movie_and_captions.pipeline import CaptionPipeline
+from movie_and_captions.data import Data, expand_data
+
+
+class StoreUpdate(NamedTuple):
+    # the number of the videos whose captions are downloaded
+    updated_num: int
+    # the videos of the channel which were not in the store (including the ones without
+    # captions yet)
+    new_video_ids: List[str]
+
+
+def update_store(
+        store: CaptionStore,
+        caption_updater: CaptionUpdater,
+        caption_with_mecab: CaptionWithMecab,
+        target_channel_id: str,
+        incremental: bool,
+        pipeline: Optional[CaptionPipeline] = None,
+        batch_size: int = 100,
+        recheck_since: Optional[datetime.datetime] = None
+) -> StoreUpdate:
+    """Updates the store with the channel."""
+    old_summaries = store.summaries()
+    # only the changed videos are written into the store
+    if pipeline is None:
+        changes = caption_updater.update(target_channel_id, old_summaries,
+                                         incremental=incremental, recheck_since=recheck_since)
+        store.upsert(changes.updated)
+        store.delete(changes.removed)
+        updated_num = len(changes.updated)
+        video_ids = changes.video_ids
+    else:
+        # each video is written as soon as it is downloaded and augmented
+        plan = pipeline.run(target_channel_id, old_summaries,
+                            lambda video_datum: store.upsert([video_datum]),
+                            incremental=incremental, recheck_since=recheck_since)
+        store.delete(plan.removed)
+        updated_num = len(plan.downloads)
+        video_ids = plan.video_ids
+    # augment the new videos (and the ones augmented with older rules), reading them on demand
+    video_ids = store.video_ids_to_augment(CaptionWithMecab.AUGMENTER_VERSION)
+    for i in range(0, len(video_ids), batch_size):
+        batch = [store[video_id] for video_id in video_ids[i:i + batch_size]]
+        store.upsert(caption_with_mecab.do(batch))
+    return StoreUpdate(updated_num, [video_id for video_id in video_ids
+                                     if video_id not in old_summaries])
+
+
+def read_channel_ids(channel_file: TextIO) -> List[str]:
+    """Reads one channel id per line, skipping empty lines, `#` comments and duplicates."""
+    channel_ids = []
+    for line in channel_file:
+        channel_id = line.split('#', 1)[0].strip()
+        if channel_id != '':
+            channel_ids.append(channel_id)
+    return list(dict.fromkeys(channel_ids))
+
+
+class MultiChannelSync:
+    """Syncs many channels in one process, each into its own file in `output_dir`.
+
+    The channels are synced concurrently, sharing the api clients (and so their connection
+    pools, rate limit and quota budget), one thread pool for the requests and the MeCab
+    workers. Each channel has its own journal in `output_dir`, so that an interrupted
+    batch can be resumed.
+    """
+
+    def __init__(
+            self,
+            youtube_api: YoutubeAPI,
+            dirty_youtube_api: DirtyYoutubeAPI,
+            caption_with_mecab: CaptionWithMecab,
+            output_dir: Path,
+            logger: Logger = getLogger(__name__),
+            max_workers: int = 1,
+            channel_workers: int = 4,
+            output_format: str = 'pickle',
+            incremental: bool = False,
+            resume: bool = False,
+            use_pipeline: bool = False,
+            max_in_flight: int = 16
+    ) -> None:
+        assert output_format in ('pickle', 'sqlite')
+        assert channel_workers >= 1
+        self._youtube_api = youtube_api
+        self._dirty_youtube_api = dirty_youtube_api
+        self._caption_with_mecab = caption_with_mecab
+        self._output_dir = output_dir
+        self._logger = logger
+        self._max_workers = max_workers
+        self._channel_workers = channel_workers
+        self._output_format = output_format
+        self._incremental = incremental
+        self._resume = resume
+        self._use_pipeline = use_pipeline
+        self._max_in_flight = max_in_flight
+
+    def output_path(self, channel_id: str) -> Path:
+        suffix = '.pkl' if self._output_format == 'pickle' else '.sqlite3'
+        return self._output_dir / (channel_id + suffix)
+
+    def _sync_channel(self, channel_id: str, executor: ThreadPoolExecutor) -> None:
+        logger = self._logger.getChild(channel_id)
+        journal = CheckpointJournal(self._output_dir / (channel_id + '.journal'),
+                                    resume=self._resume, logger=logger)
+        caption_updater = CaptionUpdater(self._youtube_api, self._dirty_youtube_api, logger,
+                                         max_workers=self._max_workers, journal=journal,
+                                         executor=executor)
+        pipeline: Optional[CaptionPipeline] = None
+        if self._use_pipeline:
+            pipeline = CaptionPipeline(caption_updater, self._caption_with_mecab, logger,
+                                       max_in_flight=self._max_in_flight)
+        output_path = self.output_path(channel_id)
+
+        if self._output_format == 'sqlite':
+            store = CaptionStore(output_path)
+            try:
+                update_store(store, caption_updater, self._caption_with_mecab, channel_id,
+                             self._incremental, pipeline)
+            finally:
+                store.close()
+        else:
+            old_data: Data = []
+            if output_path.exists():
+                # note: this is BAD because pickle.load is not secure for outside binary file!
+                with output_path.open('rb') as f:
+                    old_data = expand_data(pickle.load(f))
+            if pipeline is None:
+                data = caption_updater.do(channel_id, old_data, incremental=self._incremental)
+                data = self._caption_with_mecab.do(data)
+            else:
+                data = pipeline.do(channel_id, old_data, incremental=self._incremental)
+            # replace the old file at once, not to leave a broken one
+            temporary_path = output_path.with_name(output_path.name + '.tmp')
+            with temporary_path.open('wb') as f:
+                pickle.dump(data, f)
+            temporary_path.replace(output_path)
+        journal.finish()
+
+    def run(self, channel_ids: Sequence[str]) -> Dict[str, Optional[Exception]]:
+        """Syncs the channels, and returns the error of each channel (None if succeeded)."""
+        self._output_dir.mkdir(parents=True, exist_ok=True)
+        # a channel given twice would be synced twice at once, into the same file and journal
+        channel_ids = list(dict.fromkeys(channel_ids))
+        errors: Dict[str, Optional[Exception]] = {}
+        with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            with ThreadPoolExecutor(max_workers=self._channel_workers) as channel_executor:
+                futures = {channel_id: channel_executor.submit(self._sync_channel, channel_id,
+                                                               executor)
+                           for channel_id in channel_ids}
+                for channel_id, future in futures.items():
+                    try:
+                        future.result()
+                        errors[channel_id] = None
+                    except QuotaExceeded as error:
+                        # the rest of the channel is synced in the next runs
+                        self._logger.warning('{}: {}'.format(channel_id, error))
+                        errors[channel_id] = error
+                    except Exception as error:
+                        self._logger.exception('failed to sync {}'.format(channel_id))
+                        errors[channel_id] = error
+        return errors
@@ -0,0 +1,129 @@
+from logging import getLogger, Logger
+from pathlib import Path
+from typing import Dict, Optional, Tuple, Any
+import os
+import threading
+
+from movie_and_captions.caption_store import dumps_json, loads_json
+from movie_and_captions.data import VideoDatum
+
+
+class CheckpointJournal:
+    """Append-only journal of the caption checks and the downloaded `VideoDatum`s, in json lines.
+
+    Each record is fsync-ed before `record` returns, so that the downloads done before
+    a crash (quota exhaustion, network failure, Ctrl-C, ...) are not done again when
+    the run is resumed. The result of each caption check (the updated caption info, or None)
+    is recorded too, since the checks use most of the api quota.
+    The journal is removed by `finish` once the output is written.
+    Only the position of each record is kept in memory, and the records are read back from
+    the file when they are needed, not to hold a second copy of the downloaded captions.
+    """
+
+    def __init__(
+            self,
+            path: Path,
+            resume: bool = False,
+            logger: Logger = getLogger(__name__)
+    ) -> None:
+        self._path = path
+        self._logger = logger
+        self._lock = threading.Lock()
+        # video id -> (offset, size) of the record in the file
+        self._records: Dict[str, Tuple[int, int]] = {}
+        # video id -> the updated caption info found by the check (None if not updated)
+        self._checks: Dict[str, Optional[Dict[str, Any]]] = {}
+        self._size = 0
+        if resume and path.exists():
+            self._load()
+            self._logger.warning('resume with {} checked and {} downloaded videos in {}'
+                                 .format(len(self._checks), len(self._records), path))
+        elif path.exists():
+            self._logger.warning('{} is discarded (use --resume to continue it)'.format(path))
+            path.unlink()
+        self._file = open(str(path), 'ab')
+        self._read_file = open(str(path), 'rb')
+
+    def _load(self) -> None:
+        valid_size = 0
+        with open(str(self._path), 'rb') as f:
+            for line in f:
+                try:
+                    if not line.endswith(b'\n'):
+                        raise ValueError('truncated record')
+                    record = loads_json(line.decode('utf-8'))
+                except ValueError:
+                    # only the last record can be broken by a crash while writing it
+                    if f.read(1) != b'':
+                        raise
+                    self._logger.warning('drop the broken last record of {}'.format(self._path))
+                    break
+                if 'checked_video_id' in record:
+                    self._checks[record['checked_video_id']] = record['caption_info']
+                else:
+                    self._records[record['video_info']['video_id']] = (valid_size, len(line))
+                valid_size += len(line)
+        os.truncate(str(self._path), valid_size)
+        self._size = valid_size
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def __contains__(self, video_id: object) -> bool:
+        return video_id in self._records
+
+    def _read(self, offset: int, size: int) -> VideoDatum:
+        # pread does not move the file position, so the records are read from many threads
+        return loads_json(os.pread(self._read_file.fileno(), size, offset).decode('utf-8'))
+
+    def get(self, video_id: str) -> Optional[VideoDatum]:
+        with self._lock:
+            record = self._records.get(video_id)
+        if record is None:
+            return None
+        return self._read(*record)
+
+    def summaries(self) -> Dict[str, VideoDatum]:
+        """Returns the recorded data having only 'video_info' and 'caption_info'."""
+        with self._lock:
+            records = dict(self._records)
+        summaries = {}
+        for video_id, record in records.items():
+            video_datum = self._read(*record)
+            summaries[video_id] = dict(video_info=video_datum['video_info'],
+                                       caption_info=video_datum['caption_info'])
+        return summaries
+
+    def checks(self) -> Dict[str, Optional[Dict[str, Any]]]:
+        """Returns the updated caption info found by each recorded check (None if not updated)."""
+        with self._lock:
+            return dict(self._checks)
+
+    def _append(self, record: Dict[str, Any]) -> Tuple[int, int]:
+        # returns the offset and the size of the record
+        line = (dumps_json(record) + '\n').encode('utf-8')
+        offset = self._size
+        self._file.write(line)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._size += len(line)
+        return offset, len(line)
+
+    def record_check(self, video_id: str, caption_info: Optional[Dict[str, Any]]) -> None:
+        with self._lock:
+            self._append(dict(checked_video_id=video_id, caption_info=caption_info))
+            self._checks[video_id] = caption_info
+
+    def record(self, video_datum: VideoDatum) -> None:
+        with self._lock:
+            self._records[video_datum['video_info']['video_id']] = (  # type: ignore
+                self._append(video_datum))
+
+    def close(self) -> None:
+        self._file.close()
+        self._read_file.close()
+
+    def finish(self) -> None:
+        """Removes the journal, after all of the records are in the final output."""
+        self.close()
+        self._path.unlink()
@@ -0,0 +1,126 @@
+from logging import getLogger, Logger
+from typing import Optional, Set
+import datetime
+import threading
+import time
+
+from movie_and_captions.youtube_api import QuotaBudget, QuotaExceeded
+from movie_and_captions.caption_updater import CaptionUpdater
+from movie_and_captions.caption_with_mecab import CaptionWithMecab
+from movie_and_captions.caption_store import CaptionStore
+from movie_and_captions.pipeline import CaptionPipeline
+from movie_and_captions.channel_sync import update_store, StoreUpdate
+from movie_and_captions.metrics import Metrics
+
+
+class CaptionDaemon:
+    """Keeps a store in sync with the channel, polling it with the warm api clients and taggers.
+
+    The interval between the polls is reset to `min_interval` when something is updated or
+    a new video is uploaded (even without captions yet, since they often follow soon),
+    and multiplied by `backoff` (up to `max_interval`) when nothing is updated or the poll
+    fails. Only the captions of the videos published in `recheck_period` are checked again,
+    and the uploads playlist is fully scanned once in `full_scan_interval` to catch the
+    deleted videos. The quota budget and the metrics are saved after each poll.
+    """
+
+    def __init__(
+            self,
+            caption_updater: CaptionUpdater,
+            caption_with_mecab: CaptionWithMecab,
+            store: CaptionStore,
+            target_channel_id: str,
+            logger: Logger = getLogger(__name__),
+            pipeline: Optional[CaptionPipeline] = None,
+            quota_budget: Optional[QuotaBudget] = None,
+            min_interval: datetime.timedelta = datetime.timedelta(minutes=5),
+            max_interval: datetime.timedelta = datetime.timedelta(hours=6),
+            backoff: float = 2.0,
+            recheck_period: datetime.timedelta = datetime.timedelta(days=7),
+            full_scan_interval: datetime.timedelta = datetime.timedelta(days=1),
+            metrics: Optional[Metrics] = None
+    ) -> None:
+        assert min_interval <= max_interval
+        assert backoff >= 1.0
+        self._caption_updater = caption_updater
+        self._caption_with_mecab = caption_with_mecab
+        self._store = store
+        self._target_channel_id = target_channel_id
+        self._logger = logger
+        # the videos are written into the store as soon as they are augmented
+        if pipeline is None:
+            pipeline = CaptionPipeline(caption_updater, caption_with_mecab,
+                                       logger.getChild('CaptionPipeline'))
+        self._pipeline = pipeline
+        self._quota_budget = quota_budget
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._backoff = backoff
+        self._recheck_period = recheck_period
+        self._full_scan_interval = full_scan_interval
+        self._metrics = metrics
+        self._interval = min_interval
+        self._last_full_scan: Optional[float] = None
+        # the videos not in the store which are already seen, not to count them as new again
+        self._seen_video_ids: Set[str] = set()
+        self._stop_event = threading.Event()
+
+    @property
+    def interval(self) -> datetime.timedelta:
+        return self._interval
+
+    def stop(self) -> None:
+        """Stops `run` after the current poll (can be called from other threads)."""
+        self._stop_event.set()
+
+    def poll(self) -> StoreUpdate:
+        """Updates the store once."""
+        now = time.monotonic()
+        full_scan = (self._last_full_scan is None
+                     or now - self._last_full_scan >= self._full_scan_interval.total_seconds())
+        recheck_since = datetime.datetime.now(datetime.timezone.utc) - self._recheck_period
+        self._logger.info('poll the channel (full scan: {})'.format(full_scan))
+        store_update = update_store(self._store, self._caption_updater,
+                                    self._caption_with_mecab, self._target_channel_id,
+                                    incremental=not full_scan, pipeline=self._pipeline,
+                                    recheck_since=recheck_since)
+        if full_scan:
+            self._last_full_scan = now
+        return store_update
+
+    def _next_interval(self, updated_num: int, new_num: int) -> datetime.timedelta:
+        if updated_num > 0 or new_num > 0:
+            return self._min_interval
+        return min(self._interval * self._backoff, self._max_interval)
+
+    def run(self) -> None:
+        while not self._stop_event.is_set():
+            try:
+                store_update = self.poll()
+                updated_num = store_update.updated_num
+                new_video_ids = [video_id for video_id in store_update.new_video_ids
+                                 if video_id not in self._seen_video_ids]
+                self._seen_video_ids.update(store_update.new_video_ids)
+                self._logger.warning('{} videos are updated, {} new videos are found'
+                                     .format(updated_num, len(new_video_ids)))
+                result = 'ok'
+            except QuotaExceeded as error:
+                self._logger.warning('{}; wait for the quota'.format(error))
+                updated_num = 0
+                new_video_ids = []
+                result = 'quota_exceeded'
+            except Exception:
+                # keep running through the network failures and so on
+                self._logger.exception('failed to poll the channel')
+                updated_num = 0
+                new_video_ids = []
+                result = 'error'
+            if self._quota_budget is not None:
+                self._quota_budget.save()
+            self._interval = self._next_interval(updated_num, len(new_video_ids))
+            if self._metrics is not None:
+                self._metrics.increment('polls_total', result=result)
+                self._metrics.set('poll_interval_seconds', self._interval.total_seconds())
+                self._metrics.save()
+            self._logger.info('next poll in {}'.format(self._interval))
+            self._stop_event.wait(self._interval.total_seconds())
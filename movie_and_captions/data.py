@@ -1,12 +1,94 @@
-from typing import List, Dict, Any, Dict, Union
+from typing import List, Dict, Any, Dict, Union, NamedTuple
+
+from movie_and_captions.models import Caption, AugmentedCaption, CaptionBlock
 
 
 # Data: List[VideoDatum]
 # VideoDatum: Dict[Key, Info]
-# Key: OneOfThe['caption_info', 'video_info', 'captions']
+# Key: OneOfThe['caption_info', 'video_info', 'captions',
+#                'augmented_captions', 'augmentation_info']
 # Info: Dict[str, Any] or List[Dict[str, Any]]
 
 _Info = Union[Dict[str, Any], List[Dict[str, Any]]]
 VideoDatum = Dict[str, _Info]
 
 Data = List[VideoDatum]
+
+# CompactVideoDatum: VideoDatum whose 'captions' and 'augmented_captions' are `CaptionBlock`s
+#                    instead of the lists of dicts
+_CAPTION_KEYS = [('captions', Caption), ('augmented_captions', AugmentedCaption)]
+
+
+def compact_video_datum(video_datum: VideoDatum) -> Dict[str, Any]:
+    compact_datum: Dict[str, Any] = dict(video_datum)
+    for key, caption_type in _CAPTION_KEYS:
+        if key in video_datum:
+            captions = [caption_type(**caption_asdict)  # type: ignore
+                        for caption_asdict in video_datum[key]]
+            compact_datum[key] = CaptionBlock.from_captions(
+                captions, is_augmented=caption_type is AugmentedCaption)
+    return compact_datum
+
+
+def expand_video_datum(compact_datum: Dict[str, Any]) -> VideoDatum:
+    video_datum: VideoDatum = dict(compact_datum)
+    for key, _ in _CAPTION_KEYS:
+        if isinstance(compact_datum.get(key), CaptionBlock):
+            video_datum[key] = [caption._asdict() for caption in compact_datum[key]]
+    return video_datum
+
+
+def compact_data(data: Data) -> List[Dict[str, Any]]:
+    """Packs the captions of each video, to write (and read) the pickle file much faster."""
+    return [compact_video_datum(video_datum) for video_datum in data]
+
+
+def expand_data(data: List[Dict[str, Any]]) -> Data:
+    """Unpacks the data made by `compact_data`, and returns the other data as they are."""
+    return [expand_video_datum(video_datum) for video_datum in data]
+
+
+class ChangeSet(NamedTuple):
+    # all the video ids of the channel, in the playlist order
+    video_ids: List[str]
+    # the newly downloaded data
+    updated: Data
+    # the ids of the videos which are no longer in the channel
+    removed: List[str]
+
+
+class DataDelta(NamedTuple):
+    # the data of the videos not in the old data
+    added: Data
+    # the data of the videos whose captions (or augmentations) are changed
+    updated: Data
+    # the ids of the videos which are in the old data but not in the new one
+    removed: List[str]
+
+
+def _is_changed(old_datum: VideoDatum, new_datum: VideoDatum) -> bool:
+    # the unchanged videos are passed through as the same objects, and the changed ones have
+    # a newer caption or an augmentation with other rules, so the captions are not compared
+    if new_datum is old_datum:
+        return False
+    return (new_datum['caption_info'] != old_datum['caption_info']
+            or new_datum.get('augmentation_info') != old_datum.get('augmentation_info'))
+
+
+def diff_data(old_data: Data, new_data: Data) -> DataDelta:
+    """Returns the changes from `old_data` to `new_data`, in the order of `new_data`."""
+    video_id_to_old_datum = {old_datum['video_info']['video_id']: old_datum  # type: ignore
+                             for old_datum in old_data}
+    added: Data = []
+    updated: Data = []
+    new_video_ids = set()
+    for new_datum in new_data:
+        video_id = new_datum['video_info']['video_id']  # type: ignore
+        new_video_ids.add(video_id)
+        old_datum = video_id_to_old_datum.get(video_id)
+        if old_datum is None:
+            added.append(new_datum)
+        elif _is_changed(old_datum, new_datum):
+            updated.append(new_datum)
+    removed = [video_id for video_id in video_id_to_old_datum if video_id not in new_video_ids]
+    return DataDelta(added=added, updated=updated, removed=removed)
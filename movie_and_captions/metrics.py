@@ -0,0 +1,291 @@
+from contextlib import contextmanager
+from logging import getLogger, Logger
+from pathlib import Path
+from typing import Dict, Tuple, List, Optional, Iterator, Any, NamedTuple, Sequence
+import bisect
+import cProfile
+import json
+import pstats
+import threading
+import time
+
+
+# (name, label pairs sorted by the label names)
+MetricKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+# upper bounds of the histogram buckets in seconds, from a cached api response to a long video
+DEFAULT_BUCKETS: Tuple[float, ...] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                                      10.0, 30.0, 60.0)
+
+PROMETHEUS_PREFIX = 'movie_and_captions_'
+
+
+def _key(name: str, labels: Dict[str, Any]) -> MetricKey:
+    return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+
+def _format_labels(label_pairs: Sequence[Tuple[str, str]]) -> str:
+    if len(label_pairs) == 0:
+        return ''
+    escaped = [(label, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for label, value in label_pairs]
+    return '{' + ','.join('{}="{}"'.format(label, value) for label, value in escaped) + '}'
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """Counts of the observed values in the buckets, in the same way as prometheus."""
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        self.buckets = buckets
+        # the last one is the +Inf bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.max = 0.0
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def observe(self, value: float) -> None:
+        # a value equal to the upper bound is in the bucket (`le`)
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def merge(self, other: 'Histogram') -> None:
+        assert self.buckets == other.buckets
+        self.counts = [count + other_count
+                       for count, other_count in zip(self.counts, other.counts)]
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q: float) -> float:
+        """Estimates the quantile, interpolating linearly in the bucket (like prometheus)."""
+        count = self.count
+        if count == 0:
+            return 0.0
+        rank = q * count
+        cumulative = 0
+        for i, bucket_count in enumerate(self.counts):
+            if bucket_count > 0 and cumulative + bucket_count >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.max
+                upper = min(upper, self.max)
+                return lower + (upper - lower) * (rank - cumulative) / bucket_count
+            cumulative += bucket_count
+        return self.max
+
+    def summary(self) -> Dict[str, float]:
+        count = self.count
+        return dict(count=count, sum=self.sum, mean=self.sum / count if count > 0 else 0.0,
+                    max=self.max, p50=self.quantile(0.5), p90=self.quantile(0.9),
+                    p99=self.quantile(0.99))
+
+
+class MetricsSnapshot(NamedTuple):
+    counters: Dict[MetricKey, float]
+    gauges: Dict[MetricKey, float]
+    histograms: Dict[MetricKey, Histogram]
+
+
+class Metrics:
+    """Counters, gauges and histograms of a run, saved as json and as a prometheus textfile.
+
+    The methods are thread-safe. The metrics of the worker processes are sent back with
+    `take` and added with `merge`.
+    With `profile_path`, the code in `stage` (and `profile`) is also profiled with cProfile,
+    and the statistics of all the calls are dumped there.
+    """
+
+    def __init__(
+            self,
+            json_path: Optional[Path] = None,
+            prometheus_path: Optional[Path] = None,
+            profile_path: Optional[Path] = None,
+            logger: Logger = getLogger(__name__)
+    ) -> None:
+        self._json_path = json_path
+        self._prometheus_path = prometheus_path
+        self._profile_path = profile_path
+        self._logger = logger
+        self._lock = threading.Lock()
+        self._started = time.time()
+        self._counters: Dict[MetricKey, float] = {}
+        self._gauges: Dict[MetricKey, float] = {}
+        self._histograms: Dict[MetricKey, Histogram] = {}
+        self._profile_stats: Optional[pstats.Stats] = None
+        # a thread profiles only the outermost stage, since enabling another profiler
+        # replaces the running one
+        self._thread_local = threading.local()
+
+    @property
+    def profiling(self) -> bool:
+        return self._profile_path is not None
+
+    def increment(self, name: str, value: float = 1, **labels: Any) -> None:
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels: Any) -> None:
+        with self._lock:
+            self._gauges[_key(name, labels)] = value
+
+    def observe(self, name: str, value: float, **labels: Any) -> None:
+        key = _key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def counter(self, name: str, **labels: Any) -> float:
+        with self._lock:
+            return self._counters.get(_key(name, labels), 0)
+
+    def histogram(self, name: str, **labels: Any) -> Optional[Histogram]:
+        with self._lock:
+            return self._histograms.get(_key(name, labels))
+
+    @contextmanager
+    def timer(self, name: str, **labels: Any) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    @contextmanager
+    def profile(self) -> Iterator[None]:
+        if not self.profiling or getattr(self._thread_local, 'profiling', False):
+            yield
+            return
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # python >= 3.12 runs one profiler at a time in a process, so the stages in the
+            # other threads are not profiled meanwhile
+            yield
+            return
+        self._thread_local.profiling = True
+        try:
+            yield
+        finally:
+            profiler.disable()
+            self._thread_local.profiling = False
+            with self._lock:
+                if self._profile_stats is None:
+                    self._profile_stats = pstats.Stats(profiler)
+                else:
+                    self._profile_stats.add(profiler)
+
+    @contextmanager
+    def stage(self, stage: str) -> Iterator[None]:
+        """Measures (and profiles) a stage of the work, into `stage_seconds`."""
+        with self.profile(), self.timer('stage_seconds', stage=stage):
+            yield
+
+    def stages(self) -> Dict[str, Histogram]:
+        with self._lock:
+            return {dict(label_pairs)['stage']: histogram
+                    for (name, label_pairs), histogram in sorted(self._histograms.items())
+                    if name == 'stage_seconds'}
+
+    def take(self) -> MetricsSnapshot:
+        """Returns the metrics so far, and resets them (in the worker processes)."""
+        with self._lock:
+            snapshot = MetricsSnapshot(self._counters, self._gauges, self._histograms)
+            self._counters, self._gauges, self._histograms = {}, {}, {}
+        return snapshot
+
+    def merge(self, snapshot: MetricsSnapshot) -> None:
+        with self._lock:
+            for key, value in snapshot.counters.items():
+                self._counters[key] = self._counters.get(key, 0) + value
+            self._gauges.update(snapshot.gauges)
+            for key, histogram in snapshot.histograms.items():
+                if key in self._histograms:
+                    self._histograms[key].merge(histogram)
+                else:
+                    merged = self._histograms[key] = Histogram(histogram.buckets)
+                    merged.merge(histogram)
+
+    def _update_run_gauges(self) -> None:
+        now = time.time()
+        self.set('run_seconds', now - self._started)
+        self.set('last_update_timestamp_seconds', now)
+
+    def summary(self) -> Dict[str, Any]:
+        self._update_run_gauges()
+        with self._lock:
+            return dict(
+                counters={name + _format_labels(label_pairs): value
+                          for (name, label_pairs), value in sorted(self._counters.items())},
+                gauges={name + _format_labels(label_pairs): value
+                        for (name, label_pairs), value in sorted(self._gauges.items())},
+                histograms={name + _format_labels(label_pairs): histogram.summary()
+                            for (name, label_pairs), histogram
+                            in sorted(self._histograms.items())})
+
+    def to_prometheus(self) -> str:
+        """Formats the metrics in the text exposition format of prometheus."""
+        self._update_run_gauges()
+        lines: List[str] = []
+        with self._lock:
+            for metric_type, metrics in [('counter', self._counters), ('gauge', self._gauges)]:
+                previous_name = None
+                for (name, label_pairs), value in sorted(metrics.items()):
+                    if name != previous_name:
+                        lines.append('# TYPE {}{} {}'.format(PROMETHEUS_PREFIX, name,
+                                                             metric_type))
+                        previous_name = name
+                    lines.append('{}{}{} {}'.format(PROMETHEUS_PREFIX, name,
+                                                    _format_labels(label_pairs),
+                                                    _format_value(value)))
+            previous_name = None
+            for (name, label_pairs), histogram in sorted(self._histograms.items()):
+                if name != previous_name:
+                    lines.append('# TYPE {}{} histogram'.format(PROMETHEUS_PREFIX, name))
+                    previous_name = name
+                cumulative = 0
+                for upper, count in zip(list(histogram.buckets) + [float('inf')],
+                                        histogram.counts):
+                    cumulative += count
+                    bucket_labels = list(label_pairs) + [('le', _format_value(upper))]
+                    lines.append('{}{}_bucket{} {}'.format(PROMETHEUS_PREFIX, name,
+                                                           _format_labels(bucket_labels),
+                                                           cumulative))
+                lines.append('{}{}_sum{} {}'.format(PROMETHEUS_PREFIX, name,
+                                                    _format_labels(label_pairs),
+                                                    _format_value(histogram.sum)))
+                lines.append('{}{}_count{} {}'.format(PROMETHEUS_PREFIX, name,
+                                                      _format_labels(label_pairs), cumulative))
+        return '\n'.join(lines) + '\n'
+
+    def save(self) -> None:
+        """Writes the metrics (and the profile) into the given paths, replacing them atomically.
+
+        It can be called many times (after each poll of the daemon, for example).
+        """
+        if self._json_path is not None:
+            self._write_atomically(self._json_path,
+                                   json.dumps(self.summary(), indent=2, sort_keys=True) + '\n')
+        if self._prometheus_path is not None:
+            # the textfile collector of node_exporter must not read a partially written file
+            self._write_atomically(self._prometheus_path, self.to_prometheus())
+        if self._profile_path is not None:
+            with self._lock:
+                if self._profile_stats is not None:
+                    self._profile_stats.dump_stats(str(self._profile_path))
+
+    def _write_atomically(self, path: Path, content: str) -> None:
+        temporary_path = path.with_name(path.name + '.tmp')
+        temporary_path.write_text(content, encoding='utf-8')
+        temporary_path.replace(path)
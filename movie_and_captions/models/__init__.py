@@ -2,3 +2,4 @@ from .caption import Caption
 from .caption_info import CaptionInfo
 from .video_info import VideoInfo
 from .augmented_caption import AugmentedCaption
+from .caption_block import CaptionBlock
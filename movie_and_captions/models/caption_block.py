@@ -0,0 +1,159 @@
+from typing import Sequence, Union, List, Tuple, Iterator, Optional, overload
+from array import array
+from datetime import time
+import struct
+import sys
+
+from .caption import Caption
+from .augmented_caption import AugmentedCaption
+
+
+def time_to_milliseconds(t: time) -> int:
+    return ((t.hour * 60 + t.minute) * 60 + t.second) * 1000 + t.microsecond // 1000
+
+
+def milliseconds_to_time(milliseconds: int) -> time:
+    seconds, milliseconds = divmod(milliseconds, 1000)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return time(hours, minutes, seconds, milliseconds * 1000)
+
+
+class CaptionBlock(Sequence):
+    """Captions (or augmented captions) of one video, packed into a few flat arrays.
+
+    The begin / end times are int32 arrays in milliseconds, and each of the string fields is
+    a utf-8 buffer with a uint32 offset array. Items are made lazily as `Caption` or
+    `AugmentedCaption` when they are accessed.
+
+    Layout of the bytes (native byte order, every section is aligned to 4 bytes):
+        header: magic, version, is_augmented, byte order, (padding), number of captions
+        begins[n], ends[n]
+        for each string field: offsets[n + 1], utf-8 data
+    `from_buffer` only makes views of the given buffer, so an mmap-ed file can be used as it is.
+    """
+
+    _MAGIC = b'CBLK'
+    _VERSION = 1
+    _HEADER = struct.Struct('=4sBBBxI')
+    _BYTE_ORDER = 0 if sys.byteorder == 'little' else 1
+
+    def __init__(self, buffer: Union[bytes, bytearray, memoryview]) -> None:
+        # use `from_captions` or `from_buffer` instead
+        view = memoryview(buffer).cast('B')
+        magic, version, is_augmented, byte_order, length = self._HEADER.unpack_from(view)
+        if magic != self._MAGIC or version != self._VERSION:
+            raise ValueError('not a caption block (version {})'.format(self._VERSION))
+        if byte_order != self._BYTE_ORDER:
+            raise ValueError('the caption block is made in the other byte order')
+        self._buffer = view
+        self._length = length
+        self._is_augmented = bool(is_augmented)
+        position = self._HEADER.size
+        array_size = 4 * length
+        self._begins = view[position:position + array_size].cast('i')
+        position += array_size
+        self._ends = view[position:position + array_size].cast('i')
+        position += array_size
+        self._fields: List[Tuple[memoryview, memoryview]] = []
+        for _ in range(3 if self._is_augmented else 1):
+            offsets = view[position:position + array_size + 4].cast('I')
+            position += array_size + 4
+            data_size = offsets[length]
+            self._fields.append((offsets, view[position:position + data_size]))
+            position += self._aligned(data_size)
+        self._size = position
+
+    @staticmethod
+    def _aligned(size: int) -> int:
+        return (size + 3) // 4 * 4
+
+    @classmethod
+    def from_buffer(cls, buffer: Union[bytes, bytearray, memoryview]) -> 'CaptionBlock':
+        return cls(buffer)
+
+    @classmethod
+    def from_captions(
+            cls,
+            captions: Sequence[Union[Caption, AugmentedCaption]],
+            is_augmented: Optional[bool] = None
+    ) -> 'CaptionBlock':
+        if is_augmented is None:
+            is_augmented = len(captions) > 0 and isinstance(captions[0], AugmentedCaption)
+        length = len(captions)
+        sections = [cls._HEADER.pack(cls._MAGIC, cls._VERSION, is_augmented, cls._BYTE_ORDER,
+                                     length)]
+        sections.append(array('i', [time_to_milliseconds(caption.begin)
+                                    for caption in captions]).tobytes())
+        sections.append(array('i', [time_to_milliseconds(caption.end)
+                                    for caption in captions]).tobytes())
+        field_names = ['content', 'short_title', 'yomi'] if is_augmented else ['content']
+        for field_name in field_names:
+            encoded_strings = [getattr(caption, field_name).encode('utf-8')
+                               for caption in captions]
+            offsets = [0]
+            for encoded_string in encoded_strings:
+                offsets.append(offsets[-1] + len(encoded_string))
+            sections.append(array('I', offsets).tobytes())
+            data = b''.join(encoded_strings)
+            sections.append(data + b'\0' * (cls._aligned(len(data)) - len(data)))
+        return cls(b''.join(sections))
+
+    def to_bytes(self) -> bytes:
+        return self._buffer[:self._size].tobytes()
+
+    def __reduce__(self) -> Tuple:
+        return (CaptionBlock.from_buffer, (self.to_bytes(),))
+
+    @property
+    def is_augmented(self) -> bool:
+        return self._is_augmented
+
+    @property
+    def nbytes(self) -> int:
+        return self._size
+
+    def __len__(self) -> int:
+        return self._length
+
+    def begin_milliseconds(self, index: int) -> int:
+        return self._begins[index]
+
+    def end_milliseconds(self, index: int) -> int:
+        return self._ends[index]
+
+    def _string(self, field_index: int, index: int) -> str:
+        offsets, data = self._fields[field_index]
+        return str(data[offsets[index]:offsets[index + 1]], 'utf-8')
+
+    def content(self, index: int) -> str:
+        return self._string(0, index)
+
+    def _item(self, index: int) -> Union[Caption, AugmentedCaption]:
+        begin = milliseconds_to_time(self._begins[index])
+        end = milliseconds_to_time(self._ends[index])
+        if self._is_augmented:
+            return AugmentedCaption(begin, end, self._string(0, index),
+                                    self._string(1, index), self._string(2, index))
+        return Caption(begin, end, self._string(0, index))
+
+    @overload
+    def __getitem__(self, index: int) -> Union[Caption, AugmentedCaption]:
+        pass
+
+    @overload  # noqa: F811
+    def __getitem__(self, index: slice) -> List[Union[Caption, AugmentedCaption]]:
+        pass
+
+    def __getitem__(self, index):  # noqa: F811
+        if isinstance(index, slice):
+            return [self._item(i) for i in range(*index.indices(self._length))]
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError('caption block index out of range')
+        return self._item(index)
+
+    def __iter__(self) -> Iterator[Union[Caption, AugmentedCaption]]:
+        for index in range(self._length):
+            yield self._item(index)
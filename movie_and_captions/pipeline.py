@@ -0,0 +1,78 @@
+from logging import getLogger, Logger
+from typing import Callable, Mapping, Optional
+import datetime
+from tqdm import tqdm
+
+from movie_and_captions.caption_updater import CaptionUpdater, UpdatePlan
+from movie_and_captions.caption_with_mecab import CaptionWithMecab
+from movie_and_captions.data import Data, VideoDatum
+
+
+class CaptionPipeline:
+    """Downloads and augments the updated captions in a stream.
+
+    Each `VideoDatum` is augmented as soon as its captions are downloaded, and passed to
+    the sink right after that, so that the network and MeCab work at the same time and
+    only a bounded number of data are held in memory.
+    """
+
+    def __init__(
+            self,
+            caption_updater: CaptionUpdater,
+            caption_with_mecab: CaptionWithMecab,
+            logger: Logger = getLogger(__name__),
+            max_in_flight: int = 16
+    ) -> None:
+        self._caption_updater = caption_updater
+        self._caption_with_mecab = caption_with_mecab
+        self._logger = logger
+        assert max_in_flight >= 1
+        self._max_in_flight = max_in_flight
+
+    def run(
+            self,
+            target_channel_id: str,
+            old_summaries: Mapping[str, VideoDatum],
+            sink: Callable[[VideoDatum], None],
+            incremental: bool = False,
+            recheck_since: Optional[datetime.datetime] = None
+    ) -> UpdatePlan:
+        """Passes each updated and augmented datum to `sink`, in playlist order.
+
+        The removed videos in the returned plan are left to the caller.
+        """
+        plan = self._caption_updater.plan_update(target_channel_id, old_summaries, incremental,
+                                                 recheck_since)
+        self._logger.info('%d videos to download', len(plan.downloads))
+        downloaded_data = self._caption_updater.iterate_downloads(
+            plan.downloads, max_in_flight=self._max_in_flight)
+        augmented_data = self._caption_with_mecab.iterate_augmented(
+            downloaded_data, max_in_flight=self._max_in_flight)
+        for video_datum in tqdm(augmented_data, total=len(plan.downloads)):
+            sink(video_datum)
+        return plan
+
+    def do(
+            self,
+            target_channel_id: str,
+            old_data: Data,
+            incremental: bool = False
+    ) -> Data:
+        """Same as `CaptionUpdater.do` followed by `CaptionWithMecab.do`, in a stream."""
+        video_id_to_data = {old_datum['video_info']['video_id']: old_datum  # type: ignore
+                            for old_datum in old_data}
+        video_id_to_new_datum = {}
+
+        def sink(video_datum: VideoDatum) -> None:
+            video_id = video_datum['video_info']['video_id']  # type: ignore
+            video_id_to_new_datum[video_id] = video_datum
+
+        plan = self.run(target_channel_id, video_id_to_data, sink, incremental)
+        new_data: Data = []
+        for video_id in plan.video_ids:
+            if video_id in video_id_to_new_datum:
+                new_data.append(video_id_to_new_datum[video_id])
+            elif video_id in video_id_to_data:
+                new_data.append(video_id_to_data[video_id])
+        # the old data augmented with older rules are not in the stream
+        return self._caption_with_mecab.do(new_data)
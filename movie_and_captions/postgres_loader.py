@@ -0,0 +1,203 @@
+from logging import getLogger, Logger
+from typing import Any, Iterable, Iterator, List, Sequence, Tuple, TYPE_CHECKING
+import datetime
+import io
+import time
+
+from movie_and_captions.data import Data, VideoDatum, DataDelta
+
+# psycopg2 is needed only to load the data into postgresql, so it is imported when used
+if TYPE_CHECKING:
+    import psycopg2.extensions
+
+
+_VIDEO_COLUMNS = ['video_id', 'title', 'published', 'caption_id', 'caption_name',
+                  'caption_last_updated', 'augmenter_version']
+_CAPTION_COLUMNS = ['video_id', 'position', 'begin_time', 'end_time', 'content',
+                    'short_title', 'yomi']
+
+
+def _copy_field(value: Any) -> str:
+    # a field in the text format of COPY
+    if value is None:
+        return '\\N'
+    if isinstance(value, (datetime.datetime, datetime.time)):
+        return value.isoformat()
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+            .replace('\r', '\\r'))
+
+
+def _copy_line(values: Sequence[Any]) -> str:
+    return '\t'.join(_copy_field(value) for value in values) + '\n'
+
+
+def _video_row(video_datum: VideoDatum) -> List[Any]:
+    video_info = video_datum['video_info']
+    caption_info = video_datum['caption_info']
+    augmentation_info = video_datum.get('augmentation_info')
+    return [video_info['video_id'], video_info['title'], video_info['published'],  # type: ignore
+            caption_info['caption_id'], caption_info['name'],  # type: ignore
+            caption_info['last_updated'],  # type: ignore
+            None if augmentation_info is None else augmentation_info['version']]  # type: ignore
+
+
+def _caption_rows(video_datum: VideoDatum) -> Iterator[List[Any]]:
+    video_id = video_datum['video_info']['video_id']  # type: ignore
+    # the augmented captions are the ones shown on the site; the captions without yomi are
+    # loaded only until the data are augmented
+    if 'augmented_captions' in video_datum:
+        for position, caption in enumerate(video_datum['augmented_captions']):
+            yield [video_id, position, caption['begin'], caption['end'],  # type: ignore
+                   caption['content'], caption['short_title'], caption['yomi']]  # type: ignore
+    else:
+        for position, caption in enumerate(video_datum['captions']):
+            yield [video_id, position, caption['begin'], caption['end'],  # type: ignore
+                   caption['content'], None, None]  # type: ignore
+
+
+class PostgresLoader:
+    """Loads the data into postgresql, for the database of the site.
+
+    The rows are sent with COPY in batches of `batch_size` videos, and each of `apply` and
+    `replace_all` runs in one transaction, so that the site never sees a half-loaded state.
+    `apply` writes only the changed videos, which takes seconds where reloading all of
+    the data takes minutes.
+    """
+
+    def __init__(
+            self,
+            dsn: str,
+            logger: Logger = getLogger(__name__),
+            videos_table: str = 'videos',
+            captions_table: str = 'captions',
+            batch_size: int = 1000
+    ) -> None:
+        import psycopg2
+        from psycopg2 import sql
+        assert batch_size >= 1
+        self._logger = logger
+        self._connection: 'psycopg2.extensions.connection' = psycopg2.connect(dsn)
+        self._videos_table = sql.Identifier(videos_table)
+        self._captions_table = sql.Identifier(captions_table)
+        self._batch_size = batch_size
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def _execute(self, cursor: 'psycopg2.extensions.cursor', query: str, *args: Any) -> None:
+        from psycopg2 import sql
+        cursor.execute(sql.SQL(query).format(videos=self._videos_table,
+                                             captions=self._captions_table), *args)
+
+    def create_tables(self) -> None:
+        with self._connection, self._connection.cursor() as cursor:
+            self._execute(cursor, 'CREATE TABLE IF NOT EXISTS {videos} ('
+                          'video_id text PRIMARY KEY, '
+                          'title text NOT NULL, '
+                          'published timestamptz NOT NULL, '
+                          'caption_id text NOT NULL, '
+                          'caption_name text NOT NULL, '
+                          'caption_last_updated timestamptz NOT NULL, '
+                          'augmenter_version integer)')
+            self._execute(cursor, 'CREATE TABLE IF NOT EXISTS {captions} ('
+                          'video_id text NOT NULL '
+                          'REFERENCES {videos} (video_id) ON DELETE CASCADE, '
+                          'position integer NOT NULL, '
+                          'begin_time time NOT NULL, '
+                          'end_time time NOT NULL, '
+                          'content text NOT NULL, '
+                          'short_title text, '
+                          'yomi text, '
+                          'PRIMARY KEY (video_id, position))')
+
+    def drop_tables(self) -> None:
+        with self._connection, self._connection.cursor() as cursor:
+            self._execute(cursor, 'DROP TABLE IF EXISTS {captions}, {videos}')
+
+    def _copy(
+            self,
+            cursor: 'psycopg2.extensions.cursor',
+            table: Any,
+            columns: Sequence[str],
+            rows: Iterable[Sequence[Any]]
+    ) -> int:
+        from psycopg2 import sql
+        query = sql.SQL('COPY {} ({}) FROM STDIN').format(
+            table, sql.SQL(', ').join(sql.Identifier(column) for column in columns))
+        buffer = io.StringIO()
+        row_num = 0
+        for row in rows:
+            buffer.write(_copy_line(row))
+            row_num += 1
+        buffer.seek(0)
+        cursor.copy_expert(query.as_string(cursor), buffer)
+        return row_num
+
+    def _copy_captions(self, cursor: 'psycopg2.extensions.cursor', data: Data) -> int:
+        row_num = 0
+        for i in range(0, len(data), self._batch_size):
+            row_num += self._copy(cursor, self._captions_table, _CAPTION_COLUMNS,
+                                  (row for video_datum in data[i:i + self._batch_size]
+                                   for row in _caption_rows(video_datum)))
+        return row_num
+
+    def _upsert_videos(self, cursor: 'psycopg2.extensions.cursor', data: Data) -> None:
+        from psycopg2 import sql
+        # COPY cannot update the existing rows, so the rows are copied into a temporary table
+        # and merged with one INSERT ... ON CONFLICT
+        self._execute(cursor, 'CREATE TEMPORARY TABLE staging_videos '
+                      '(LIKE {videos} INCLUDING DEFAULTS) ON COMMIT DROP')
+        staging_table = sql.Identifier('staging_videos')
+        for i in range(0, len(data), self._batch_size):
+            self._copy(cursor, staging_table, _VIDEO_COLUMNS,
+                       (_video_row(video_datum) for video_datum in data[i:i + self._batch_size]))
+        updates = ', '.join('{0} = EXCLUDED.{0}'.format(column)
+                            for column in _VIDEO_COLUMNS[1:])
+        self._execute(cursor, 'INSERT INTO {videos} SELECT * FROM staging_videos '
+                      'ON CONFLICT (video_id) DO UPDATE SET ' + updates)
+
+    def apply(self, delta: DataDelta) -> None:
+        """Applies the changes to the tables in one transaction."""
+        start = time.perf_counter()
+        changed_data = delta.added + delta.updated
+        changed_video_ids = [video_datum['video_info']['video_id']  # type: ignore
+                             for video_datum in changed_data]
+        with self._connection, self._connection.cursor() as cursor:
+            if len(delta.removed) > 0:
+                # the captions are deleted in cascade
+                self._execute(cursor, 'DELETE FROM {videos} WHERE video_id = ANY(%s)',
+                              (delta.removed,))
+            if len(changed_data) > 0:
+                self._upsert_videos(cursor, changed_data)
+                # the captions of a video are replaced as a whole, since the number of them
+                # may be changed
+                self._execute(cursor, 'DELETE FROM {captions} WHERE video_id = ANY(%s)',
+                              (changed_video_ids,))
+                caption_num = self._copy_captions(cursor, changed_data)
+            else:
+                caption_num = 0
+        self._logger.warning('{} added, {} updated and {} removed videos ({} captions) are '
+                             'loaded in {:.1f} s'
+                             .format(len(delta.added), len(delta.updated), len(delta.removed),
+                                     caption_num, time.perf_counter() - start))
+
+    def replace_all(self, data: Data) -> None:
+        """Replaces the whole tables with the data in one transaction."""
+        start = time.perf_counter()
+        with self._connection, self._connection.cursor() as cursor:
+            self._execute(cursor, 'TRUNCATE {captions}, {videos}')
+            for i in range(0, len(data), self._batch_size):
+                self._copy(cursor, self._videos_table, _VIDEO_COLUMNS,
+                           (_video_row(video_datum)
+                            for video_datum in data[i:i + self._batch_size]))
+            caption_num = self._copy_captions(cursor, data)
+        self._logger.warning('{} videos ({} captions) are loaded in {:.1f} s'
+                             .format(len(data), caption_num, time.perf_counter() - start))
+
+    def count(self) -> Tuple[int, int]:
+        """Returns the numbers of the rows in the videos and the captions tables."""
+        with self._connection, self._connection.cursor() as cursor:
+            self._execute(cursor, 'SELECT (SELECT count(*) FROM {videos}), '
+                          '(SELECT count(*) FROM {captions})')
+            video_num, caption_num = cursor.fetchone()
+        return video_num, caption_num
@@ -0,0 +1,406 @@
+from array import array
+from logging import getLogger, Logger
+from pathlib import Path
+from typing import (Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple, Any,
+                    AbstractSet)
+import bisect
+import json
+import mmap
+import struct
+import sys
+import unicodedata
+
+from movie_and_captions.data import Data, VideoDatum, DataDelta
+from movie_and_captions.models.caption_block import time_to_milliseconds
+
+
+def normalize(text: str) -> str:
+    """Folds the width, the case and katakana into hiragana, for both of the index and queries."""
+    # imported here, not to load jaconv on every start of main.py
+    import jaconv
+    # the lines of a caption are joined, as in `CaptionWithMecab.augment_caption`
+    text = text.replace('\n', '')
+    return jaconv.kata2hira(unicodedata.normalize('NFKC', text).lower())
+
+
+class SearchHit(NamedTuple):
+    video_id: str
+    begin_ms: int
+    content: str
+
+
+class _Document(NamedTuple):
+    video_id: str
+    begin_ms: int
+    content: str
+    normalized_content: str
+    normalized_yomi: str
+
+
+def _documents(data: Iterable[VideoDatum]) -> Iterator[_Document]:
+    # only the augmented captions are searched, since they are the ones shown on the site
+    for video_datum in data:
+        video_id = video_datum['video_info']['video_id']  # type: ignore
+        for caption in video_datum.get('augmented_captions', []):
+            yield _Document(video_id, time_to_milliseconds(caption['begin']),  # type: ignore
+                            caption['content'], normalize(caption['content']),  # type: ignore
+                            normalize(caption['yomi']))  # type: ignore
+
+
+# a gram is a pair of code points packed into an uint64.
+# the first character of each text is also indexed after `_START`, for the prefix lookups
+_START = 0
+
+
+def _gram(first: int, second: int) -> int:
+    return (first << 21) | second
+
+
+def _text_grams(text: str) -> Iterator[int]:
+    if len(text) == 0:
+        return
+    yield _gram(_START, ord(text[0]))
+    for i in range(len(text) - 1):
+        yield _gram(ord(text[i]), ord(text[i + 1]))
+
+
+def _query_grams(query: str, prefix: bool) -> List[int]:
+    grams = [_gram(ord(query[i]), ord(query[i + 1])) for i in range(len(query) - 1)]
+    if prefix:
+        grams.append(_gram(_START, ord(query[0])))
+    return grams
+
+
+def _align(position: int) -> int:
+    return (position + 7) // 8 * 8
+
+
+class _StringTable:
+    """Strings in an utf-8 buffer with an uint32 offset array, read from an mmap-ed file."""
+
+    def __init__(self, file_map: mmap.mmap, offsets: memoryview, data_position: int) -> None:
+        self._file_map = file_map
+        self._offsets = offsets
+        self._data_position = data_position
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        return self._file_map[self._data_position + self._offsets[i]:
+                              self._data_position + self._offsets[i + 1]].decode('utf-8')
+
+    def find(self, needle: bytes) -> Iterator[int]:
+        """Yields the indices of the strings containing `needle`, in order."""
+        end = self._data_position + self._offsets[len(self)]
+        position = self._file_map.find(needle, self._data_position, end)
+        while position != -1:
+            relative_position = position - self._data_position
+            i = bisect.bisect_right(self._offsets, relative_position) - 1
+            if relative_position + len(needle) <= self._offsets[i + 1]:
+                yield i
+                # skip the rest of the string
+                position = self._file_map.find(needle, self._data_position + self._offsets[i + 1],
+                                               end)
+            else:
+                # the match spans two strings
+                position = self._file_map.find(needle, position + 1, end)
+
+
+class IndexSegment:
+    """An immutable file of the index: character bigram postings of the captions and the texts.
+
+    Layout of the file (native byte order, every section is aligned to 8 bytes):
+        header: magic, version, byte order, (padding), numbers of videos, documents, grams
+                and postings
+        gram keys[grams] (uint64, sorted), posting offsets[grams + 1], postings (document ids)
+        video of each document[documents], begin of each document[documents] (milliseconds)
+        string tables of the video ids, the contents, the normalized contents and yomi:
+            offsets[n + 1], utf-8 data
+    The file is mmap-ed and only the touched pages are read.
+    """
+
+    _MAGIC = b'CIDX'
+    _VERSION = 1
+    _HEADER = struct.Struct('=4sBBxxIIII')
+    _BYTE_ORDER = 0 if sys.byteorder == 'little' else 1
+
+    def __init__(self, path: Path) -> None:
+        with path.open('rb') as f:
+            self._file_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        # the views must be released before the map is closed
+        self._views: List[memoryview] = [memoryview(self._file_map)]
+        magic, version, byte_order, video_num, document_num, gram_num, posting_num = \
+            self._HEADER.unpack_from(self._file_map)
+        if magic != self._MAGIC or version != self._VERSION:
+            raise ValueError('not a search index segment (version {})'.format(self._VERSION))
+        if byte_order != self._BYTE_ORDER:
+            raise ValueError('the search index segment is made in the other byte order')
+        self._position = _align(self._HEADER.size)
+        self._gram_keys = self._take('Q', gram_num)
+        self._posting_offsets = self._take('I', gram_num + 1)
+        self._postings = self._take('I', posting_num)
+        self._document_videos = self._take('I', document_num)
+        self._document_begins = self._take('i', document_num)
+        video_id_table = self._take_strings(video_num)
+        self._contents = self._take_strings(document_num)
+        self._normalized_contents = self._take_strings(document_num)
+        self._normalized_yomis = self._take_strings(document_num)
+        self._video_ids = [video_id_table[i] for i in range(video_num)]
+
+    def _take(self, typecode: str, length: int) -> memoryview:
+        size = array(typecode).itemsize * length
+        byte_view = self._views[0][self._position:self._position + size]
+        view = byte_view.cast(typecode)
+        self._views.extend([byte_view, view])
+        self._position = _align(self._position + size)
+        return view
+
+    def _take_strings(self, length: int) -> _StringTable:
+        offsets = self._take('I', length + 1)
+        table = _StringTable(self._file_map, offsets, self._position)
+        self._position = _align(self._position + offsets[length])
+        return table
+
+    def close(self) -> None:
+        for view in reversed(self._views):
+            view.release()
+        self._file_map.close()
+
+    @property
+    def video_ids(self) -> List[str]:
+        return self._video_ids
+
+    def __len__(self) -> int:
+        return len(self._document_videos)
+
+    @classmethod
+    def write(cls, path: Path, documents: Iterable[_Document]) -> None:
+        video_ids: List[str] = []
+        video_indices: Dict[str, int] = {}
+        document_videos = array('I')
+        document_begins = array('i')
+        string_fields: List[List[str]] = [[], [], []]
+        postings: Dict[int, array] = {}
+        for document_id, document in enumerate(documents):
+            if document.video_id not in video_indices:
+                video_indices[document.video_id] = len(video_ids)
+                video_ids.append(document.video_id)
+            document_videos.append(video_indices[document.video_id])
+            document_begins.append(document.begin_ms)
+            string_fields[0].append(document.content)
+            string_fields[1].append(document.normalized_content)
+            string_fields[2].append(document.normalized_yomi)
+            # the documents are added in order, so each posting list is sorted
+            for gram in (set(_text_grams(document.normalized_content))
+                         | set(_text_grams(document.normalized_yomi))):
+                posting = postings.get(gram)
+                if posting is None:
+                    posting = postings[gram] = array('I')
+                posting.append(document_id)
+
+        gram_keys = array('Q', sorted(postings))
+        posting_offsets = array('I', [0])
+        all_postings = array('I')
+        for gram in gram_keys:
+            all_postings.extend(postings[gram])
+            posting_offsets.append(len(all_postings))
+
+        sections: List[Any] = [gram_keys, posting_offsets, all_postings, document_videos,
+                               document_begins]
+        for strings in [video_ids] + string_fields:
+            encoded = [string.encode('utf-8') for string in strings]
+            string_offsets = array('I', [0])
+            for string in encoded:
+                string_offsets.append(string_offsets[-1] + len(string))
+            sections.extend([string_offsets, b''.join(encoded)])
+
+        temporary_path = path.with_name(path.name + '.tmp')
+        with temporary_path.open('wb') as f:
+            header = cls._HEADER.pack(cls._MAGIC, cls._VERSION, cls._BYTE_ORDER, len(video_ids),
+                                      len(document_videos), len(gram_keys), len(all_postings))
+            f.write(header)
+            position = len(header)
+            for section in sections:
+                f.write(b'\0' * (_align(position) - position))
+                position = _align(position)
+                data = section if isinstance(section, bytes) else section.tobytes()
+                f.write(data)
+                position += len(data)
+        temporary_path.replace(path)
+
+    def _posting(self, gram: int) -> memoryview:
+        i = bisect.bisect_left(self._gram_keys, gram)
+        if i == len(self._gram_keys) or self._gram_keys[i] != gram:
+            return self._postings[0:0]
+        return self._postings[self._posting_offsets[i]:self._posting_offsets[i + 1]]
+
+    def _candidates(self, query: str, prefix: bool) -> List[int]:
+        grams = _query_grams(query, prefix)
+        if len(grams) == 0:
+            # one character, which is not indexed alone; find it in the texts directly
+            needle = query.encode('utf-8')
+            return sorted(set(self._normalized_contents.find(needle))
+                          | set(self._normalized_yomis.find(needle)))
+        postings = sorted((self._posting(gram) for gram in set(grams)), key=len)
+        candidates: Iterable[int] = postings[0]
+        for posting in postings[1:]:
+            # the candidates are verified with the texts anyway, so a few are left as they are
+            if len(candidates) <= 64:  # type: ignore
+                break
+            candidates = set(candidates).intersection(posting)
+        return sorted(candidates)
+
+    def _matches(self, document_id: int, query: str, prefix: bool) -> bool:
+        texts = [self._normalized_contents[document_id], self._normalized_yomis[document_id]]
+        if prefix:
+            return any(text.startswith(query) for text in texts)
+        return any(query in text for text in texts)
+
+    def search(
+            self,
+            normalized_query: str,
+            prefix: bool = False,
+            deleted: AbstractSet[str] = frozenset()
+    ) -> Iterator[SearchHit]:
+        if len(normalized_query) == 0:
+            return
+        for document_id in self._candidates(normalized_query, prefix):
+            video_id = self._video_ids[self._document_videos[document_id]]
+            if video_id in deleted or not self._matches(document_id, normalized_query, prefix):
+                continue
+            yield SearchHit(video_id, self._document_begins[document_id],
+                            self._contents[document_id])
+
+    def documents(self, deleted: AbstractSet[str] = frozenset()) -> Iterator[_Document]:
+        for document_id in range(len(self)):
+            video_id = self._video_ids[self._document_videos[document_id]]
+            if video_id not in deleted:
+                yield _Document(video_id, self._document_begins[document_id],
+                                self._contents[document_id],
+                                self._normalized_contents[document_id],
+                                self._normalized_yomis[document_id])
+
+
+class SearchIndex:
+    """Inverted index of character bigrams over the contents and the yomi of the captions.
+
+    The index is kept in `directory` as immutable segment files and a manifest. `update`
+    writes only the changed videos into a new segment, and marks their old documents in the
+    older segments as deleted; the segments are merged into one when there are more than
+    `max_segments`. Only one process should update the index at once.
+    """
+
+    MANIFEST_NAME = 'manifest.json'
+
+    def __init__(
+            self,
+            directory: Path,
+            logger: Logger = getLogger(__name__),
+            max_segments: int = 8
+    ) -> None:
+        assert max_segments >= 1
+        self._directory = directory
+        self._directory.mkdir(parents=True, exist_ok=True)
+        self._logger = logger
+        self._max_segments = max_segments
+        self._next_segment = 0
+        # (name, segment, deleted video ids), oldest first
+        self._segments: List[Tuple[str, IndexSegment, Set[str]]] = []
+        manifest_path = self._directory / self.MANIFEST_NAME
+        if manifest_path.exists():
+            with manifest_path.open(encoding='utf-8') as f:
+                manifest = json.load(f)
+            self._next_segment = manifest['next_segment']
+            for entry in manifest['segments']:
+                segment = IndexSegment(self._directory / entry['name'])
+                self._segments.append((entry['name'], segment, set(entry['deleted'])))
+
+    @property
+    def is_empty(self) -> bool:
+        return len(self._segments) == 0
+
+    def close(self) -> None:
+        for _, segment, _ in self._segments:
+            segment.close()
+        self._segments = []
+
+    def _write_segment(self, documents: Iterable[_Document]) -> Tuple[str, IndexSegment]:
+        name = 'segment-{:06d}.idx'.format(self._next_segment)
+        self._next_segment += 1
+        IndexSegment.write(self._directory / name, documents)
+        return name, IndexSegment(self._directory / name)
+
+    def _save(self, obsolete_names: Iterable[str] = ()) -> None:
+        manifest = dict(next_segment=self._next_segment,
+                        segments=[dict(name=name, deleted=sorted(deleted))
+                                  for name, _, deleted in self._segments])
+        manifest_path = self._directory / self.MANIFEST_NAME
+        temporary_path = manifest_path.with_name(manifest_path.name + '.tmp')
+        with temporary_path.open('w', encoding='utf-8') as f:
+            json.dump(manifest, f)
+        temporary_path.replace(manifest_path)
+        # the segments are removed after the manifest stops referring to them
+        for name in obsolete_names:
+            (self._directory / name).unlink()
+
+    def _replace_segments(self, documents: Iterable[_Document]) -> None:
+        name, segment = self._write_segment(documents)
+        old_segments = self._segments
+        self._segments = [(name, segment, set())]
+        self._save([old_name for old_name, _, _ in old_segments])
+        for _, old_segment, _ in old_segments:
+            old_segment.close()
+
+    def rebuild(self, data: Data) -> None:
+        """Indexes the whole data, replacing the index."""
+        self._replace_segments(_documents(data))
+        self._logger.info('{} captions are indexed'.format(len(self._segments[0][1])))
+
+    def compact(self) -> None:
+        """Merges all the segments into one, dropping the deleted documents."""
+        self._replace_segments(document for _, segment, deleted in self._segments
+                               for document in segment.documents(deleted))
+
+    def update(self, delta: DataDelta) -> None:
+        """Applies the changes since the data the index was built from."""
+        changed_data = delta.added + delta.updated
+        stale_video_ids = set(delta.removed) | {
+            video_datum['video_info']['video_id']  # type: ignore
+            for video_datum in changed_data}
+        obsolete_names = []
+        segments = []
+        for name, segment, deleted in self._segments:
+            deleted |= stale_video_ids.intersection(segment.video_ids)
+            if len(deleted) < len(segment.video_ids):
+                segments.append((name, segment, deleted))
+            else:
+                obsolete_names.append(name)
+                segment.close()
+        self._segments = segments
+        if len(changed_data) > 0:
+            name, segment = self._write_segment(_documents(changed_data))
+            self._segments.append((name, segment, set()))
+        self._save(obsolete_names)
+        if len(self._segments) > self._max_segments:
+            self.compact()
+
+    def search(
+            self,
+            query: str,
+            prefix: bool = False,
+            limit: Optional[int] = None
+    ) -> List[SearchHit]:
+        """Finds the captions whose content or yomi contains (or starts with) `query`.
+
+        The query is normalized in the same way as the texts, so katakana matches hiragana
+        and full-width letters match half-width ones. The hits in the newer segments come first.
+        """
+        normalized_query = normalize(query)
+        hits: List[SearchHit] = []
+        for _, segment, deleted in reversed(self._segments):
+            for hit in segment.search(normalized_query, prefix, deleted):
+                if limit is not None and len(hits) >= limit:
+                    return hits
+                hits.append(hit)
+        return hits
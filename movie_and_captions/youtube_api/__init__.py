@@ -1,2 +1,4 @@
 from .youtube_api import YoutubeAPI
 from .dirty_youtube_api import DirtyYoutubeAPI
+from .response_cache import ResponseCache
+from .quota import QuotaBudget, QuotaExceeded
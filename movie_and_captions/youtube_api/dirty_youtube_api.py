@@ -1,14 +1,104 @@
 from logging import getLogger, Logger
-from typing import List
-import requests
+from typing import List, Optional, Tuple, Iterable, Iterator, TYPE_CHECKING
+import random
+import threading
+import time
 
 from ..models import VideoInfo, CaptionInfo, Caption
-from .treat_webvtt import webvtt_string_to_parsed
+from ..metrics import Metrics
+from .rate_limiter import TokenBucket
+from .treat_webvtt import webvtt_chunks_to_parsed
+
+if TYPE_CHECKING:
+    import requests
 
 
 class DirtyYoutubeAPI:
-    def __init__(self, logger: Logger = getLogger(__name__)) -> None:
+    def __init__(
+            self,
+            logger: Logger = getLogger(__name__),
+            pool_size: int = 10,
+            timeout: Tuple[float, float] = (5.0, 30.0),
+            retry_num: int = 5,
+            backoff_base: float = 1.0,
+            requests_per_second: Optional[float] = None,
+            timedtext_url: str = 'https://www.youtube.com/api/timedtext',
+            metrics: Optional[Metrics] = None
+    ) -> None:
         self._logger = logger
+        if metrics is None:
+            metrics = Metrics()
+        self._metrics = metrics
+        self._timedtext_url = timedtext_url
+        self._pool_size = pool_size
+        # built on the first download, since importing requests takes a while
+        self._session: Optional['requests.Session'] = None
+        self._session_lock = threading.Lock()
+        self._timeout = timeout
+        self._retry_num = retry_num
+        self._backoff_base = backoff_base
+        self._rate_limiter: Optional[TokenBucket] = None
+        if requests_per_second is not None:
+            self._rate_limiter = TokenBucket(requests_per_second, capacity=pool_size)
+
+    def _get_session(self) -> 'requests.Session':
+        import requests
+        import requests.adapters
+        with self._session_lock:
+            if self._session is None:
+                # share one keep-alive connection pool among all downloads (and threads)
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                        pool_maxsize=self._pool_size)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self._session = session
+            return self._session
+
+    def _get_with_repeat(
+            self,
+            url: str,
+            params: dict,
+            stream: bool = False
+    ) -> 'requests.Response':
+        import requests
+        session = self._get_session()
+        retriable_statuses = {429, 500, 502, 503, 504}
+        method_id = 'timedtext'
+        for i in range(self._retry_num):
+            if self._rate_limiter is not None:
+                self._rate_limiter.acquire()
+            if i > 0:
+                self._metrics.increment('api_retries_total', method=method_id)
+            self._metrics.increment('api_requests_total', method=method_id)
+            start = time.perf_counter()
+            try:
+                response = session.get(url, params=params, timeout=self._timeout,
+                                       stream=stream)
+                # until the headers are received, since the body may be streamed
+                self._metrics.observe('api_request_seconds', time.perf_counter() - start,
+                                      method=method_id)
+                if not response.ok:
+                    self._metrics.increment('api_errors_total', method=method_id,
+                                            status=response.status_code)
+                if response.status_code not in retriable_statuses:
+                    if not response.ok:
+                        response.close()
+                    response.raise_for_status()
+                    return response
+                response.close()
+                self._logger.warning('status {} is returned, retrying...'
+                                     .format(response.status_code))
+            except (requests.ConnectionError, requests.Timeout) as error:
+                self._metrics.observe('api_request_seconds', time.perf_counter() - start,
+                                      method=method_id)
+                self._metrics.increment('api_errors_total', method=method_id,
+                                        status=type(error).__name__)
+                self._logger.warning('An http error occurs during download, retrying...')
+                self._logger.warning('Error information: {}'.format(error))
+            # exponential backoff with full jitter
+            time.sleep(random.uniform(0, self._backoff_base * 2 ** i))
+        raise requests.HTTPError('http request failed after {} trying.'.format(self._retry_num))
 
     def download_caption(
             self,
@@ -19,11 +109,43 @@ class DirtyYoutubeAPI:
         target_language = 'ja'
         target_caption_name = target_caption_info.name
 
-        timedtext_api = 'https://www.youtube.com/api/timedtext'
         # get captions
         request_captions = dict(fmt='vtt', v=target_video_id, lang=target_language)
         if target_caption_name != '':
             request_captions['name'] = target_caption_name
-        captions_vtt_response = requests.get(timedtext_api, params=request_captions)
-        captions = webvtt_string_to_parsed(captions_vtt_response.text)
+        with self._metrics.profile():
+            start = time.perf_counter()
+            captions_vtt_response = self._get_with_repeat(self._timedtext_url,
+                                                          request_captions, stream=True)
+            request_seconds = time.perf_counter() - start
+            with captions_vtt_response:
+                # parse the captions while they are downloaded
+                if captions_vtt_response.encoding is None:
+                    captions_vtt_response.encoding = 'utf-8'
+                chunks = captions_vtt_response.iter_content(chunk_size=64 * 1024,
+                                                            decode_unicode=True)
+                # the time waiting for the chunks is the download, and the rest is the parse
+                receive_seconds = [0.0]
+                start = time.perf_counter()
+                captions = webvtt_chunks_to_parsed(self._timed_chunks(chunks, receive_seconds))
+                parse_seconds = time.perf_counter() - start - receive_seconds[0]
+                # the bytes on the wire (before decompressed)
+                downloaded_bytes = captions_vtt_response.raw.tell()
+        self._metrics.observe('stage_seconds', request_seconds + receive_seconds[0],
+                              stage='download')
+        self._metrics.observe('stage_seconds', parse_seconds, stage='parse_webvtt')
+        self._metrics.increment('downloaded_bytes_total', downloaded_bytes, method='timedtext')
+        self._metrics.increment('videos_total', stage='downloaded')
+        self._metrics.increment('cues_total', len(captions), stage='parsed')
         return captions
+
+    def _timed_chunks(self, chunks: Iterable[str], seconds: List[float]) -> Iterator[str]:
+        # adds the time spent in receiving the chunks to `seconds[0]`
+        iterator = iter(chunks)
+        while True:
+            start = time.perf_counter()
+            chunk = next(iterator, None)
+            seconds[0] += time.perf_counter() - start
+            if chunk is None:
+                return
+            yield chunk
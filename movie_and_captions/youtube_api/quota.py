@@ -0,0 +1,143 @@
+from logging import getLogger, Logger
+from pathlib import Path
+from typing import Dict, Optional
+import datetime
+import json
+import threading
+
+
+# quota units consumed by one request of each api method
+# see: https://developers.google.com/youtube/v3/determine_quota_cost
+QUOTA_COSTS: Dict[str, int] = {
+    'youtube.channels.list': 1,
+    'youtube.playlistItems.list': 1,
+    'youtube.videos.list': 1,
+    'youtube.captions.list': 50,
+}
+
+
+def quota_cost(method_id: str) -> int:
+    return QUOTA_COSTS.get(method_id, 1)
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+# the daily quota is reset at midnight in Pacific Time
+# note: the daylight saving time is ignored, so the day may be switched one hour off
+_QUOTA_TIMEZONE = datetime.timezone(datetime.timedelta(hours=-8))
+
+
+def _quota_day() -> str:
+    return datetime.datetime.now(_QUOTA_TIMEZONE).date().isoformat()
+
+
+class QuotaBudget:
+    """Daily budget of the api quota, shared by all the requests of `YoutubeAPI`.
+
+    The quota used today and the time each video was last checked are kept in `path`
+    across runs, so that the videos skipped for the budget are checked first in the
+    next runs.
+    The channels synced at once `reserve` the units for their checks when they schedule
+    them, so that they split the budget instead of counting the same units twice.
+    """
+
+    def __init__(
+            self,
+            daily_limit: int,
+            path: Optional[Path] = None,
+            logger: Logger = getLogger(__name__)
+    ) -> None:
+        self._daily_limit = daily_limit
+        self._path = path
+        self._logger = logger
+        self._lock = threading.Lock()
+        self._day = _quota_day()
+        self._used = 0
+        # units set aside by `reserve` and not used yet
+        self._reserved = 0
+        self._last_checked: Dict[str, str] = {}
+        if path is not None and path.exists():
+            with path.open(encoding='utf-8') as f:
+                state = json.load(f)
+            if state['day'] == self._day:
+                self._used = state['used']
+            self._last_checked = state['last_checked']
+
+    @property
+    def daily_limit(self) -> int:
+        return self._daily_limit
+
+    @property
+    def used(self) -> int:
+        with self._lock:
+            self._switch_day()
+            return self._used
+
+    @property
+    def remaining(self) -> int:
+        """Units neither used nor reserved."""
+        with self._lock:
+            self._switch_day()
+            return max(0, self._daily_limit - self._used - self._reserved)
+
+    def _switch_day(self) -> None:
+        day = _quota_day()
+        if day != self._day:
+            self._day = day
+            self._used = 0
+
+    def reserve(self, units: int) -> int:
+        """Sets aside up to `units` of the remaining units, and returns the units set aside.
+
+        The reserved units are not charged until they are given back with `release`.
+        """
+        with self._lock:
+            self._switch_day()
+            reserved = max(0, min(units, self._daily_limit - self._used - self._reserved))
+            self._reserved += reserved
+            return reserved
+
+    def release(self, units: int) -> None:
+        with self._lock:
+            self._reserved = max(0, self._reserved - units)
+
+    def charge(self, method_id: str) -> None:
+        """Consumes the quota for one request, or raises `QuotaExceeded` without consuming."""
+        cost = quota_cost(method_id)
+        with self._lock:
+            self._switch_day()
+            left = max(0, self._daily_limit - self._used - self._reserved)
+            if cost > left:
+                raise QuotaExceeded('{} needs {} units, but only {} of {} units are left today'
+                                    .format(method_id, cost, left, self._daily_limit))
+            self._used += cost
+
+    def refund(self, method_id: str) -> None:
+        with self._lock:
+            self._used = max(0, self._used - quota_cost(method_id))
+
+    def exhaust(self) -> None:
+        # the server says the quota is exceeded (used by other clients, for example)
+        with self._lock:
+            self._switch_day()
+            self._used = max(self._used, self._daily_limit)
+
+    def mark_checked(self, video_id: str) -> None:
+        with self._lock:
+            self._last_checked[video_id] = datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+    def last_checked(self, video_id: str) -> Optional[str]:
+        """Returns when the video was last checked in iso format (comparable as strings)."""
+        return self._last_checked.get(video_id)
+
+    def save(self) -> None:
+        if self._path is None:
+            return
+        with self._lock:
+            state = dict(day=self._day, used=self._used, last_checked=self._last_checked)
+        temporary_path = self._path.with_name(self._path.name + '.tmp')
+        with temporary_path.open('w', encoding='utf-8') as f:
+            json.dump(state, f)
+        temporary_path.replace(self._path)
@@ -0,0 +1,31 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """Thread-safe token bucket which allows `rate` acquisitions per second on average.
+
+    At most `capacity` acquisitions can happen in a burst.
+    """
+
+    def __init__(self, rate: float, capacity: int = 1) -> None:
+        assert rate > 0
+        assert capacity >= 1
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = float(capacity)
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self._capacity,
+                                   self._tokens + (now - self._last_refill) * self._rate)
+                self._last_refill = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait_seconds = (1 - self._tokens) / self._rate
+            time.sleep(wait_seconds)
@@ -0,0 +1,140 @@
+from logging import getLogger, Logger
+from pathlib import Path
+from typing import NamedTuple, Optional, Any
+import datetime
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+import urllib.parse
+
+from .quota import quota_cost
+
+
+class CacheEntry(NamedTuple):
+    etag: str
+    body: Any
+
+
+class CacheStats(NamedTuple):
+    hits: int
+    misses: int
+    quota_saved: int
+
+
+class ResponseCache:
+    """Persistent cache of api responses, revalidated with `If-None-Match`.
+
+    Each response is stored as one json file named after the hash of the request uri.
+    The api key is removed from the uri before it is hashed or stored, so that it is never
+    written into the cache.
+    The file's mtime is used as the last access time for the eviction.
+    """
+
+    # the files of the former versions, which stored the uri with the api key, are removed
+    # by `prune`
+    _SUFFIX = '.response.json'
+
+    def __init__(
+            self,
+            directory: Path,
+            max_bytes: int = 256 * 1024 * 1024,
+            max_age: datetime.timedelta = datetime.timedelta(days=30),
+            logger: Logger = getLogger(__name__)
+    ) -> None:
+        self._directory = directory
+        self._directory.mkdir(parents=True, exist_ok=True)
+        self._max_bytes = max_bytes
+        self._max_age = max_age
+        self._logger = logger
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._quota_saved = 0
+
+    @staticmethod
+    def _strip_key(uri: str) -> str:
+        parts = urllib.parse.urlsplit(uri)
+        query = [(name, value)
+                 for name, value in urllib.parse.parse_qsl(parts.query, keep_blank_values=True)
+                 if name != 'key']
+        return urllib.parse.urlunsplit(parts._replace(query=urllib.parse.urlencode(query)))
+
+    def _path_for(self, stripped_uri: str) -> Path:
+        return self._directory / (hashlib.sha256(stripped_uri.encode('utf-8')).hexdigest()
+                                  + self._SUFFIX)
+
+    def _is_expired(self, path: Path, now: float) -> bool:
+        return now - path.stat().st_mtime > self._max_age.total_seconds()
+
+    def get(self, uri: str) -> Optional[CacheEntry]:
+        uri = self._strip_key(uri)
+        path = self._path_for(uri)
+        try:
+            if self._is_expired(path, time.time()):
+                path.unlink()
+                return None
+            with path.open('r', encoding='utf-8') as f:
+                stored = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if stored['uri'] != uri:
+            return None
+        # refresh the access time for the eviction
+        os.utime(str(path))
+        return CacheEntry(stored['etag'], stored['body'])
+
+    def set(self, uri: str, etag: str, body: Any) -> None:
+        uri = self._strip_key(uri)
+        path = self._path_for(uri)
+        # write to a temporary file and rename it, so that readers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=str(self._directory), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(dict(uri=uri, etag=etag, body=body), f, ensure_ascii=False)
+            os.replace(tmp_path, str(path))
+        except OSError:
+            self._logger.warning('failed to write a cache file {}'.format(path))
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def record_hit(self, method_id: str) -> None:
+        with self._lock:
+            self._hits += 1
+            self._quota_saved += quota_cost(method_id)
+
+    def record_miss(self) -> None:
+        with self._lock:
+            self._misses += 1
+
+    @property
+    def stats(self) -> CacheStats:
+        with self._lock:
+            return CacheStats(self._hits, self._misses, self._quota_saved)
+
+    def prune(self) -> None:
+        """Removes the expired entries, then the least recently used ones beyond `max_bytes`."""
+        now = time.time()
+        entries = []
+        for path in self._directory.glob('*.json'):
+            try:
+                stat = path.stat()
+                if (not path.name.endswith(self._SUFFIX)
+                        or now - stat.st_mtime > self._max_age.total_seconds()):
+                    path.unlink()
+                else:
+                    entries.append((stat.st_mtime, stat.st_size, path))
+            except OSError:
+                continue
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_bytes <= self._max_bytes:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                continue
+            total_bytes -= size
+        self._logger.debug('response cache holds {} bytes'.format(total_bytes))
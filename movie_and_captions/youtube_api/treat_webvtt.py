@@ -1,42 +1,119 @@
-import webvtt
-from typing import List
-import datetime
+from typing import List, Iterable, Iterator, Optional, Tuple
+import itertools
 import re
 from movie_and_captions.models import Caption, CaptionInfo, VideoInfo
+from movie_and_captions.models.caption_block import milliseconds_to_time
 
 
-TIMESTAMP_PATTERN = re.compile('^(\d+)?:?(\d{2}):(\d{2})[.,](\d{3})$')
+# this module parses WebVTT in the same way as webvtt-py (0.4.2) does, in a single pass
+CUE_TEXT_TAGS_PATTERN = re.compile('<.*?>')
 
 
-def _webvtt_string_to_parsed_original_structure(webvtt_string: str) -> List[webvtt.Caption]:
-    parser = webvtt.parsers.WebVTTParser()
-    lines = webvtt_string.split('\n')
-    parser._validate(lines)
-    parser._parse(lines)
-    return parser.captions
+class MalformedWebVTTError(ValueError):
+    pass
 
 
-def _timestamp_to_time(timestamp: str) -> datetime.time:
-    m = TIMESTAMP_PATTERN.match(timestamp)
-    assert m is not None
-    hours, minutes, seconds, milisecs = m.groups()
-    if hours is None:
+def _timestamp_to_milliseconds(timestamp: str) -> int:
+    # accepts `hh:mm:ss.ttt` or `mm:ss.ttt` (hours may have more than two digits)
+    fields = timestamp.split(':')
+    if len(fields) == 3:
+        hours, minutes, seconds_and_milliseconds = fields
+    elif len(fields) == 2:
         hours = '0'
-    assert all([elem is not None for elem in [minutes, seconds, milisecs]])
-    return datetime.time(int(hours), int(minutes), int(seconds), int(milisecs) * 1000)
+        minutes, seconds_and_milliseconds = fields
+    else:
+        raise MalformedWebVTTError('Invalid timestamp: {}'.format(timestamp))
+    seconds = seconds_and_milliseconds[:2]
+    milliseconds = seconds_and_milliseconds[3:]
+    if (len(minutes) != 2 or len(seconds_and_milliseconds) != 6
+            or seconds_and_milliseconds[2] not in '.,'
+            or not (hours.isdigit() and minutes.isdigit()
+                    and seconds.isdigit() and milliseconds.isdigit())):
+        raise MalformedWebVTTError('Invalid timestamp: {}'.format(timestamp))
+    return ((int(hours) * 60 + int(minutes)) * 60 + int(seconds)) * 1000 + int(milliseconds)
 
 
-def _original_caption_to_my_caption(
-        original_caption: webvtt.Caption
-) -> Caption:
-    return Caption(_timestamp_to_time(original_caption.start),
-                   _timestamp_to_time(original_caption.end),
-                   original_caption.text)
+def _parse_cue_timings_line(line: str) -> Tuple[int, int]:
+    # ex. '00:00:01.000 --> 00:00:02.500 align:start position:0%'
+    begin_part, end_part = line.split('-->', 1)
+    end_fields = end_part.split(None, 1)
+    if not end_fields:
+        raise MalformedWebVTTError('Invalid time format in line: {}'.format(line))
+    return (_timestamp_to_milliseconds(begin_part.strip()),
+            _timestamp_to_milliseconds(end_fields[0]))
+
+
+def _parse_block(block: List[str]) -> Optional[Caption]:
+    if '-->' in block[0] or (len(block) > 1 and '-->' in block[1]):
+        cue_timings = None
+        text_lines = []
+        for line_number, line in enumerate(block):
+            if '-->' in line:
+                if cue_timings is not None:
+                    raise MalformedWebVTTError('--> found in line: {}'.format(line))
+                cue_timings = _parse_cue_timings_line(line)
+            elif line_number > 0:
+                # note: the first line is a cue identifier if it is not the timings line
+                text_lines.append(line)
+        assert cue_timings is not None
+        text = '\n'.join(text_lines)
+        if '<' in text:
+            text = CUE_TEXT_TAGS_PATTERN.sub('', text)
+        begin, end = cue_timings
+        return Caption(milliseconds_to_time(begin), milliseconds_to_time(end), text)
+    first_line = block[0]
+    is_comment = first_line == 'NOTE' or (first_line.startswith('NOTE') and len(first_line) > 5
+                                          and first_line[4].isspace())
+    is_style = first_line.startswith('STYLE') and first_line[5:].strip(' \t') == ''
+    if is_comment or is_style:
+        return None
+    raise MalformedWebVTTError('Missing timing cue in block: {}'.format(block))
+
+
+def _split_lines(chunks: Iterable[str]) -> Iterator[str]:
+    rest = ''
+    for chunk in chunks:
+        lines = (rest + chunk).split('\n')
+        rest = lines.pop()
+        yield from lines
+    yield rest
+
+
+def webvtt_lines_to_parsed(
+        lines: Iterable[str]
+) -> List[Caption]:
+    line_iterator = iter(lines)
+    signature = next(line_iterator, '')
+    if not signature.startswith('WEBVTT'):
+        raise MalformedWebVTTError('The file does not have a valid format')
+    captions = []
+    # the first block is the header (signature) block, which is skipped
+    in_header = True
+    block = [signature]
+    # an empty line is appended to flush the last block
+    for line in itertools.chain(line_iterator, ['']):
+        if line:
+            block.append(line)
+            continue
+        if not block:
+            continue
+        if in_header:
+            in_header = False
+        else:
+            caption = _parse_block(block)
+            if caption is not None:
+                captions.append(caption)
+        block = []
+    return captions
+
+
+def webvtt_chunks_to_parsed(
+        chunks: Iterable[str]
+) -> List[Caption]:
+    return webvtt_lines_to_parsed(_split_lines(chunks))
 
 
 def webvtt_string_to_parsed(
         webvtt_string: str
 ) -> List[Caption]:
-    original_captions = _webvtt_string_to_parsed_original_structure(webvtt_string)
-    return [_original_caption_to_my_caption(original_caption)
-            for original_caption in original_captions]
+    return webvtt_lines_to_parsed(webvtt_string.split('\n'))
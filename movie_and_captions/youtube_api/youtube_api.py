@@ -1,56 +1,146 @@
-from apiclient.http import HttpRequest, HttpError
-from apiclient.discovery import Resource
-from typing import Mapping, Sequence, List, Any
+from typing import (Mapping, Sequence, List, Dict, Any, AbstractSet, Iterator, Optional,
+                    TYPE_CHECKING)
 from logging import Logger, getLogger
 import datetime
+import threading
+import time
 import sys
 
 from movie_and_captions.models import CaptionInfo, VideoInfo
+from movie_and_captions.metrics import Metrics
+from .response_cache import ResponseCache
+from .quota import QuotaBudget, QuotaExceeded, quota_cost
+
+# googleapiclient (and httplib2) take a while to import, so they are imported when used
+if TYPE_CHECKING:
+    from googleapiclient.discovery import Resource
+    from googleapiclient.http import HttpRequest
+    import httplib2
 
 
 class YoutubeAPI:
     def __init__(
             self,
-            resource: Resource,
-            logger: Logger = getLogger(__name__)
+            resource: 'Resource',
+            logger: Logger = getLogger(__name__),
+            response_cache: Optional[ResponseCache] = None,
+            quota_budget: Optional[QuotaBudget] = None,
+            metrics: Optional[Metrics] = None
     ) -> None:
         self._resource = resource
         self._logger = logger
+        self._response_cache = response_cache
+        self._quota_budget = quota_budget
+        if metrics is None:
+            metrics = Metrics()
+        self._metrics = metrics
+        self._thread_local = threading.local()
+
+    @property
+    def quota_budget(self) -> Optional[QuotaBudget]:
+        return self._quota_budget
+
+    @property
+    def metrics(self) -> Metrics:
+        return self._metrics
+
+    def _get_http(self) -> 'httplib2.Http':
+        # httplib2.Http is not thread-safe, so each thread owns its own connection
+        http = getattr(self._thread_local, 'http', None)
+        if http is None:
+            from googleapiclient.http import build_http
+            http = build_http()
+            self._thread_local.http = http
+        return http
 
     def _execute_with_repeat(
             self,
-            request: HttpRequest,
+            request: 'HttpRequest',
             retry_num: int = 10
     ) -> Any:
+        from googleapiclient.errors import HttpError
+        cached = None
+        if self._response_cache is not None:
+            cached = self._response_cache.get(request.uri)
+        if cached is not None:
+            # the server answers 304 if the resource is not changed.
+            # note: the headers are copied since `list_next` shares them with the next request
+            request.headers = dict(request.headers)
+            request.headers['If-None-Match'] = cached.etag
+        method_id = request.methodId
         for i in range(retry_num):
+            if self._quota_budget is not None:
+                # raises QuotaExceeded before sending the request over the budget
+                self._quota_budget.charge(method_id)
+            if i > 0:
+                self._metrics.increment('api_retries_total', method=method_id)
+            self._metrics.increment('api_requests_total', method=method_id)
+            start = time.perf_counter()
             try:
-                response = request.execute()
+                response = request.execute(http=self._get_http())
                 break
-            except HttpError:
+            except HttpError as error:
+                status = error.resp.status
+                if cached is not None and status == 304:
+                    self._logger.debug('not modified, use the cached response')
+                    self._response_cache.record_hit(method_id)  # type: ignore
+                    if self._quota_budget is not None:
+                        self._quota_budget.refund(method_id)
+                    self._metrics.observe('api_request_seconds', time.perf_counter() - start,
+                                          method=method_id)
+                    self._metrics.increment('cache_hits_total', cache='response')
+                    return cached.body
+                self._metrics.observe('api_request_seconds', time.perf_counter() - start,
+                                      method=method_id)
+                self._metrics.increment('api_errors_total', method=method_id, status=status)
+                self._metrics.increment('quota_units_total', quota_cost(method_id),
+                                        method=method_id)
+                if status == 403 and b'quotaExceeded' in (error.content or b''):
+                    # retrying does not help until the quota is reset
+                    if self._quota_budget is not None:
+                        self._quota_budget.exhaust()
+                    raise QuotaExceeded('the daily quota is exceeded on the server') from error
                 self._logger.warning('An http error occurs during execution, retrying...')
                 self._logger.warning('Error information: {}'.format(sys.exc_info()))
         else:
             raise HttpError('http request failed after {} trying.'.format(retry_num))
+        self._metrics.observe('api_request_seconds', time.perf_counter() - start,
+                              method=method_id)
+        self._metrics.increment('quota_units_total', quota_cost(method_id), method=method_id)
+        if self._response_cache is not None:
+            self._response_cache.record_miss()
+            self._metrics.increment('cache_misses_total', cache='response')
+            if 'etag' in response:
+                self._response_cache.set(request.uri, response['etag'], response)
         return response
 
+    def _iterate_list_items(
+            self,
+            collection: 'Resource',
+            filters: Mapping[str, str],
+            part: str
+    ) -> Iterator[Any]:
+        # pages are requested lazily, so stopping the iteration saves the remaining requests
+        request = collection.list(part=part, **filters)
+        while request is not None:
+            response = self._execute_with_repeat(request)
+            yield from response['items']
+            request = collection.list_next(request, response)
+
     def _get_list_result_with_fields(
             self,
-            collection: Resource,
+            collection: 'Resource',
             filters: Mapping[str, str],
             field_selectors: Sequence[str]
     ) -> List[str]:
         assert field_selectors
         part = field_selectors[0]
         results = []
-        request = collection.list(part=part, **filters)
-        while request is not None:
-            response = self._execute_with_repeat(request)
-            for item in response['items']:
-                tmp = item
-                for field_selector in field_selectors:
-                    tmp = tmp[field_selector]
-                results.append(tmp)
-            request = collection.list_next(request, response)
+        for item in self._iterate_list_items(collection, filters, part):
+            tmp = item
+            for field_selector in field_selectors:
+                tmp = tmp[field_selector]
+            results.append(tmp)
         return results
 
     def get_playlist_id_from_channel_id(
@@ -65,30 +155,70 @@ class YoutubeAPI:
 
     def get_video_ids_from_playlist_id(
             self,
-            target_playlist_id: str
+            target_playlist_id: str,
+            known_video_ids: AbstractSet[str] = frozenset(),
+            known_until: Optional[datetime.datetime] = None,
+            stop_after_known: Optional[int] = None
     ) -> List[str]:
         collection = self._resource.playlistItems()
         max_results_max = '50'
         filters = dict(playlistId=target_playlist_id, maxResults=max_results_max)
         field_selectors = ['contentDetails', 'videoId']
 
-        return self._get_list_result_with_fields(collection, filters, field_selectors)
+        if stop_after_known is None:
+            return self._get_list_result_with_fields(collection, filters, field_selectors)
+
+        # incremental scan: the uploads playlist is newest-first, so we can stop paging
+        # when `stop_after_known` videos in a row are already known.
+        # a video is known if it is in `known_video_ids` or published before `known_until`
+        # (the latter catches videos which were scanned before but had no valid caption)
+        video_ids = []
+        known_run_length = 0
+        for item in self._iterate_list_items(collection, filters, 'contentDetails'):
+            video_id = item['contentDetails']['videoId']
+            video_ids.append(video_id)
+            published_string = item['contentDetails'].get('videoPublishedAt')
+            is_known = video_id in known_video_ids
+            if not is_known and known_until is not None and published_string is not None:
+                is_known = self._iso_8601_string_to_time(published_string) <= known_until
+            known_run_length = known_run_length + 1 if is_known else 0
+            if known_run_length >= stop_after_known:
+                self._logger.debug('{} known videos in a row, stop scanning the playlist'
+                                   .format(known_run_length))
+                break
+        return video_ids
 
     def get_video_info_from_video_id(
             self,
             target_video_id: str
     ) -> VideoInfo:
+        return self.get_video_infos_from_video_ids([target_video_id])[target_video_id]
+
+    def get_video_infos_from_video_ids(
+            self,
+            target_video_ids: Sequence[str]
+    ) -> Dict[str, VideoInfo]:
+        # note: videos which cannot be seen (deleted, private, ...) are silently dropped
+        #       by the api, so they are missing from the returned dict
         collection = self._resource.videos()
-        filters = dict(id=target_video_id)
+        # the api takes up to 50 ids at once (maxResults is not supported with `id`)
+        ids_max = 50
         parts = ['snippet']
         part = ','.join(parts)
-        fields = 'items(snippet(title,publishedAt))'
-        request = collection.list(part=part, fields=fields, **filters)
-        response = self._execute_with_repeat(request)['items'][0]
-        title = response['snippet']['title']
-        published = self._iso_8601_string_to_time(response['snippet']['publishedAt'])
-        video_info = VideoInfo(target_video_id, title, published)
-        return video_info
+        fields = 'etag,items(id,snippet(title,publishedAt))'
+        video_infos: Dict[str, VideoInfo] = {}
+        for chunk_start in range(0, len(target_video_ids), ids_max):
+            chunk = target_video_ids[chunk_start:chunk_start + ids_max]
+            filters = dict(id=','.join(chunk))
+            request = collection.list(part=part, fields=fields, **filters)
+            for item in self._execute_with_repeat(request)['items']:
+                title = item['snippet']['title']
+                published = self._iso_8601_string_to_time(item['snippet']['publishedAt'])
+                video_infos[item['id']] = VideoInfo(item['id'], title, published)
+            dropped_video_ids = [video_id for video_id in chunk if video_id not in video_infos]
+            if dropped_video_ids:
+                self._logger.warning('video info is not found for {}'.format(dropped_video_ids))
+        return video_infos
 
     def get_caption_infos_from_video_id(
             self,
@@ -99,7 +229,7 @@ class YoutubeAPI:
         filters = dict(videoId=target_video_id)
         parts = ['id', 'snippet']
         part = ','.join(parts)
-        fields = 'items(id,snippet(name,lastUpdated,language,trackKind))'
+        fields = 'etag,items(id,snippet(name,lastUpdated,language,trackKind))'
         request = collection.list(part=part, fields=fields, **filters)
         response = self._execute_with_repeat(request)
         caption_infos = [